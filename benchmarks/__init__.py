@@ -0,0 +1,4 @@
+"""
+Benchmarks for pylut: parsing, writing, resizing, combining, reversing and applying synthetic LUTs at standard cube sizes.
+Run them from the repository root with python -m benchmarks. See python -m benchmarks --help.
+"""
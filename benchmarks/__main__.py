@@ -0,0 +1,63 @@
+"""pylut benchmarks
+
+Usage:
+  benchmarks [--cases=<cases>] [--sizes=<sizes>] [--repeat=<repeat>] [--output=<file>] [--baseline=<file>] [--threshold=<fraction>] [--memory-threshold=<fraction>] [--save-baseline]
+  benchmarks --list
+
+Run from the repository root with: python -m benchmarks
+
+Options:
+  -h --help                                     show this help message and exit
+  --list                                        list the benchmark cases and exit
+  --cases <cases>                               comma separated cases to run [default: all]
+  --sizes <sizes>                               comma separated cube sizes [default: 17,33,65]
+  --repeat <repeat>                             timed runs per case, the fastest counts [default: 3]
+  --output <file>                               write the JSON report to a file instead of stdout
+  --baseline <file>                             baseline report to compare with [default: benchmarks/baseline.json]
+  --threshold <fraction>                        allowed slowdown over the baseline [default: 0.10]
+  --memory-threshold <fraction>                 allowed peak memory growth over the baseline [default: 0.20]
+  --save-baseline                               store the report as the new baseline, keeping its per-case thresholds
+
+"""
+
+import os
+import sys
+import json
+
+from docopt import docopt
+
+from .cases import CASES
+from .runner import RunBenchmarks, CompareWithBaseline, FormatComparisons, LoadReport, SaveReport
+
+def PrintProgress(result):
+	sys.stderr.write("%-20s %5d %10.4fs\n" % (result["case"], result["cubeSize"], result["seconds"]))
+
+if __name__ == "__main__":
+	arguments = docopt(__doc__)
+
+	if arguments["--list"]:
+		for caseName in CASES:
+			print(caseName)
+		sys.exit()
+
+	caseNames = None if arguments["--cases"] == "all" else arguments["--cases"].split(",")
+	sizes = [int(size) for size in arguments["--sizes"].split(",")]
+	report = RunBenchmarks(caseNames, sizes, int(arguments["--repeat"]), PrintProgress)
+
+	if arguments["--output"] is None:
+		print(json.dumps(report, indent = 2, sort_keys = True))
+	else:
+		SaveReport(report, arguments["--output"])
+
+	baselinePath = arguments["--baseline"]
+	if arguments["--save-baseline"]:
+		if os.path.isfile(baselinePath):
+			report["thresholds"] = LoadReport(baselinePath).get("thresholds", {})
+		SaveReport(report, baselinePath)
+		sys.exit()
+
+	if os.path.isfile(baselinePath):
+		comparisons = CompareWithBaseline(report, LoadReport(baselinePath), float(arguments["--threshold"]), float(arguments["--memory-threshold"]))
+		sys.stderr.write(FormatComparisons(comparisons) + "\n")
+		if any(row["regression"] for row in comparisons):
+			sys.exit(1)
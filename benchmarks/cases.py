@@ -0,0 +1,191 @@
+"""
+Benchmark cases. A case prepares its inputs for one cube size in Setup, and Run is what gets timed. Items is the number of points, pixels or colors a single Run processes.
+"""
+
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from pylut import LUT, Color, DisableLUTCache
+
+FRAME_SHAPE = (1080, 1920, 3)
+COLOR_COUNT = 10000
+
+def SyntheticLUT(cubeSize, seed = 0):
+	"""
+	Returns a smooth, invertible LUT of cubeSize: a gamma curve with some channel crosstalk and a little noise, so parsers, writers and searches see realistic values.
+	"""
+	random = np.random.RandomState(seed + cubeSize)
+	identity = LUT.FromIdentity(cubeSize).lattice
+	crosstalk = np.array([[0.85, 0.10, 0.05], [0.05, 0.90, 0.05], [0.05, 0.10, 0.85]])
+	lattice = np.dot(identity ** 1.6, crosstalk.T) + random.uniform(-0.002, 0.002, identity.shape)
+	return LUT(np.clip(lattice, 0.0, 1.0), name = "Synthetic" + str(cubeSize))
+
+class Case:
+	"""
+	Base class of the benchmark cases.
+	"""
+	name = None
+	unit = "points"
+
+	def __init__(self, cubeSize):
+		self.cubeSize = cubeSize
+		self.lut = SyntheticLUT(cubeSize)
+		self.directory = tempfile.mkdtemp(prefix = "pylut-benchmark-")
+
+	def Setup(self):
+		pass
+
+	def Run(self):
+		raise NotImplementedError
+
+	def Items(self):
+		return self.cubeSize**3
+
+	def Teardown(self):
+		shutil.rmtree(self.directory, ignore_errors = True)
+
+	def FilePath(self, extension):
+		return os.path.join(self.directory, "benchmark" + extension)
+
+class ParseCube(Case):
+	name = "parse_cube"
+
+	def Setup(self):
+		DisableLUTCache()
+		self.lut.ToCubeFile(self.FilePath(".cube"))
+
+	def Run(self):
+		LUT.FromCubeFile(self.FilePath(".cube"))
+
+class ParseLustre3DL(Case):
+	name = "parse_lustre_3dl"
+
+	def Setup(self):
+		DisableLUTCache()
+		self.lut.ToLustre3DLFile(self.FilePath(".3dl"))
+
+	def Run(self):
+		LUT.FromLustre3DLFile(self.FilePath(".3dl"))
+
+class ParseNuke3DL(Case):
+	name = "parse_nuke_3dl"
+
+	def Setup(self):
+		DisableLUTCache()
+		self.lut.ToNuke3DLFile(self.FilePath(".3dl"))
+
+	def Run(self):
+		LUT.FromNuke3DLFile(self.FilePath(".3dl"))
+
+class ParseFSIDat(Case):
+	name = "parse_fsi_dat"
+
+	def Setup(self):
+		DisableLUTCache()
+		self.lut.ToFSIDatFile(self.FilePath(".dat"))
+
+	def Run(self):
+		LUT.FromFSIDatFile(self.FilePath(".dat"))
+
+	def Items(self):
+		# .dat files are always 64 points a side
+		return 64**3
+
+class WriteCube(Case):
+	name = "write_cube"
+
+	def Run(self):
+		self.lut.ToCubeFile(self.FilePath(".cube"))
+
+class WriteLustre3DL(Case):
+	name = "write_lustre_3dl"
+
+	def Run(self):
+		self.lut.ToLustre3DLFile(self.FilePath(".3dl"))
+
+class WriteNuke3DL(Case):
+	name = "write_nuke_3dl"
+
+	def Run(self):
+		self.lut.ToNuke3DLFile(self.FilePath(".3dl"))
+
+class WriteFSIDat(Case):
+	name = "write_fsi_dat"
+
+	def Run(self):
+		self.lut.ToFSIDatFile(self.FilePath(".dat"))
+
+	def Items(self):
+		return 64**3
+
+class Resize(Case):
+	name = "resize"
+
+	def Run(self):
+		self.lut.Resize(self.cubeSize * 2 - 1)
+
+	def Items(self):
+		return (self.cubeSize * 2 - 1)**3
+
+class Combine(Case):
+	name = "combine"
+
+	def Setup(self):
+		self.other = SyntheticLUT(self.cubeSize, seed = 1)
+
+	def Run(self):
+		self.lut.CombineWithLUT(self.other)
+
+class Reverse(Case):
+	name = "reverse"
+
+	def Run(self):
+		self.lut.Reverse()
+
+class ColorFromColor(Case):
+	name = "color_from_color"
+	unit = "colors"
+
+	def Setup(self):
+		random = np.random.RandomState(0)
+		self.colors = [Color(r, g, b) for r, g, b in random.uniform(0.0, 1.0, (COLOR_COUNT, 3))]
+
+	def Run(self):
+		for color in self.colors:
+			self.lut.ColorFromColor(color)
+
+	def Items(self):
+		return COLOR_COUNT
+
+class ApplyToArray(Case):
+	name = "apply_array"
+	unit = "pixels"
+
+	def Setup(self):
+		self.frame = np.random.RandomState(0).uniform(0.0, 1.0, FRAME_SHAPE).astype(np.float32)
+		self.out = np.empty(FRAME_SHAPE, self.lut.dtype)
+
+	def Run(self):
+		self.lut.ApplyToArray(self.frame, out = self.out)
+
+	def Items(self):
+		return FRAME_SHAPE[0] * FRAME_SHAPE[1]
+
+CASES = OrderedDict((case.name, case) for case in (
+	ParseCube,
+	ParseLustre3DL,
+	ParseNuke3DL,
+	ParseFSIDat,
+	WriteCube,
+	WriteLustre3DL,
+	WriteNuke3DL,
+	WriteFSIDat,
+	Resize,
+	Combine,
+	Reverse,
+	ColorFromColor,
+	ApplyToArray,
+))
@@ -0,0 +1,202 @@
+"""
+Runs the benchmark cases and compares their results with a baseline.
+"""
+
+import gc
+import json
+import multiprocessing
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from .cases import CASES
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+DEFAULT_SIZES = (17, 33, 65)
+DEFAULT_TIME_THRESHOLD = 0.10
+DEFAULT_MEMORY_THRESHOLD = 0.20
+# peak memory below this is compared as if it were this much, so tiny or zero baselines do not flag noise
+MEMORY_FLOOR_BYTES = 1 << 20
+
+def _PeakMemoryBytes():
+	"""
+	Peak resident memory of this process so far, or None where the resource module is not available.
+	"""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# bytes on macOS, kilobytes elsewhere
+	return peak if sys.platform == "darwin" else peak * 1024
+
+def _ProcessStatusBytes(field):
+	"""
+	A memory field such as VmRSS or VmHWM of /proc/self/status in bytes, or None outside Linux.
+	"""
+	try:
+		statusFile = open("/proc/self/status", 'r')
+	except IOError:
+		return None
+	try:
+		for line in statusFile:
+			if line.startswith(field + ":"):
+				return int(line.split()[1]) * 1024
+	finally:
+		statusFile.close()
+	return None
+
+def _ResetPeakMemory():
+	"""
+	Resets the peak resident memory (VmHWM) of this process to its current resident memory. Returns whether the kernel allowed it.
+	"""
+	try:
+		clearFile = open("/proc/self/clear_refs", 'w')
+		try:
+			clearFile.write("5")
+		finally:
+			clearFile.close()
+	except (IOError, OSError):
+		return False
+	return True
+
+def RunCase(caseName, cubeSize, repeat):
+	"""
+	Times repeat runs of one case at cubeSize. Peak memory is how far the runs raise the resident memory of the process above what it holds after Setup.
+	On Linux the peak is reset to the current resident memory before the runs. Elsewhere it falls back to how far the runs raise the peak of the whole process, which misses runs that stay below the peak of Setup, so run it in a fresh process.
+	"""
+	case = CASES[caseName](cubeSize)
+	try:
+		case.Setup()
+		gc.collect()
+		if _ResetPeakMemory():
+			memoryBefore = _ProcessStatusBytes("VmRSS")
+			peakField = "VmHWM"
+		else:
+			memoryBefore = _PeakMemoryBytes()
+			peakField = None
+		seconds = []
+		for run in range(repeat):
+			start = timeit.default_timer()
+			case.Run()
+			seconds.append(timeit.default_timer() - start)
+		memoryAfter = _PeakMemoryBytes() if peakField is None else _ProcessStatusBytes(peakField)
+	finally:
+		case.Teardown()
+
+	seconds.sort()
+	items = case.Items()
+	return {
+		"case": caseName,
+		"cubeSize": cubeSize,
+		"repeat": repeat,
+		"seconds": seconds[0],
+		"medianSeconds": seconds[len(seconds) // 2],
+		"items": items,
+		"unit": case.unit,
+		"throughput": items / seconds[0] if seconds[0] > 0 else None,
+		"peakMemoryBytes": None if memoryBefore is None or memoryAfter is None else max(memoryAfter - memoryBefore, 0),
+	}
+
+def RunBenchmarks(caseNames = None, sizes = DEFAULT_SIZES, repeat = 3, progress = None):
+	"""
+	Runs the named cases (default all of them) at every cube size, each in a fresh worker process, and returns a JSON-serializable report.
+	progress, if given, is called with every result as it completes.
+	"""
+	if caseNames is None:
+		caseNames = list(CASES)
+	for caseName in caseNames:
+		if caseName not in CASES:
+			raise NameError("Unknown benchmark case: " + str(caseName) + ". Use one of " + ", ".join(CASES))
+
+	results = []
+	pool = multiprocessing.Pool(1, maxtasksperchild = 1)
+	try:
+		for caseName in caseNames:
+			for cubeSize in sizes:
+				result = pool.apply(RunCase, (caseName, cubeSize, repeat))
+				results.append(result)
+				if progress is not None:
+					progress(result)
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		raise
+	pool.join()
+
+	return {
+		"version": 1,
+		"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"platform": platform.platform(),
+		"cpus": multiprocessing.cpu_count(),
+		"results": results,
+	}
+
+def CompareWithBaseline(report, baseline, timeThreshold = DEFAULT_TIME_THRESHOLD, memoryThreshold = DEFAULT_MEMORY_THRESHOLD):
+	"""
+	Compares the results of report with those of baseline for the same case and cube size.
+	A result regresses when it is slower than its baseline by more than timeThreshold, or uses more peak memory by more than memoryThreshold, both as fractions. Peak memory is compared against at least MEMORY_FLOOR_BYTES.
+	The baseline may override the thresholds per case with "thresholds": {"<case>": {"time": 0.25, "memory": 0.5}}.
+	Returns a list of comparison rows, one per result that has a baseline.
+	"""
+	baselineResults = dict(((result["case"], result["cubeSize"]), result) for result in baseline["results"])
+	thresholds = baseline.get("thresholds", {})
+
+	comparisons = []
+	for result in report["results"]:
+		previous = baselineResults.get((result["case"], result["cubeSize"]))
+		if previous is None:
+			continue
+		caseThresholds = thresholds.get(result["case"], {})
+		timeRatio = result["seconds"] / previous["seconds"] if previous["seconds"] > 0 else None
+		memoryRatio = None
+		if result["peakMemoryBytes"] is not None and previous.get("peakMemoryBytes") is not None:
+			memoryRatio = float(max(result["peakMemoryBytes"], 0)) / max(previous["peakMemoryBytes"], MEMORY_FLOOR_BYTES)
+
+		slower = timeRatio is not None and timeRatio > 1.0 + caseThresholds.get("time", timeThreshold)
+		larger = memoryRatio is not None and memoryRatio > 1.0 + caseThresholds.get("memory", memoryThreshold)
+		comparisons.append({
+			"case": result["case"],
+			"cubeSize": result["cubeSize"],
+			"seconds": result["seconds"],
+			"baselineSeconds": previous["seconds"],
+			"timeRatio": timeRatio,
+			"memoryRatio": memoryRatio,
+			"regression": slower or larger,
+		})
+	return comparisons
+
+def FormatComparisons(comparisons):
+	"""
+	Formats comparison rows from CompareWithBaseline as a text table.
+	"""
+	lines = ["%-20s %5s %10s %10s %7s %7s  %s" % ("case", "size", "seconds", "baseline", "time", "memory", "status")]
+	for row in comparisons:
+		lines.append("%-20s %5d %10.4f %10.4f %7s %7s  %s" % (
+			row["case"],
+			row["cubeSize"],
+			row["seconds"],
+			row["baselineSeconds"],
+			"-" if row["timeRatio"] is None else "%.2fx" % row["timeRatio"],
+			"-" if row["memoryRatio"] is None else "%.2fx" % row["memoryRatio"],
+			"REGRESSION" if row["regression"] else "ok"))
+	return "\n".join(lines)
+
+def LoadReport(path):
+	reportFile = open(path, 'r')
+	report = json.load(reportFile)
+	reportFile.close()
+	return report
+
+def SaveReport(report, path):
+	reportFile = open(path, 'w')
+	json.dump(report, reportFile, indent = 2, sort_keys = True)
+	reportFile.write("\n")
+	reportFile.close()
@@ -8,9 +8,16 @@ https://en.wikipedia.org/wiki/K-d_tree
 
 from __future__ import print_function
 
+import heapq
+import itertools
 import math
 from collections import deque
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 __author__ = 'Stefan Kögl <stefan@skoegl.net>'
 __version__ = '0.6'
 __website__ = 'https://github.com/stefankoegl/kdtree'
@@ -393,38 +400,94 @@ class KDNode(Node):
 
 
     @require_axis
-    def search_nn(self, point, best=None):
+    def search_knn(self, point, k, max_distance=None):
+        """
+        Search the k nearest nodes of the given point
+
+        point must be a location, not a node. A list of (node, distance)
+        tuples is returned, nearest first, where distance is the squared
+        distance to the point. Only nodes closer than max_distance (not
+        squared) are considered, so fewer than k nodes may be returned.
+
+        The k best nodes found so far are kept in a bounded heap. Every
+        subtree is visited nearest side first, and the far side of a split is
+        only visited while the splitting plane is closer than the k-th best
+        node. """
+
+        if k < 1:
+            raise ValueError('k must be at least 1')
+
+        limit = float('inf') if max_distance is None else max_distance ** 2
+        dimensions = range(len(point))
+
+        # max-heap of the best nodes as (-distance, tie breaker, node)
+        best = []
+        counter = itertools.count()
+
+        # (node, squared distance of the point to the node's region) pairs
+        stack = [(self, 0.0)]
+        while stack:
+            node, region_dist = stack.pop()
+            if region_dist >= limit:
+                continue
+
+            data = node.data
+            dist = 0.0
+            for i in dimensions:
+                dist += (data[i] - point[i]) ** 2
+
+            if dist < limit:
+                if len(best) < k:
+                    heapq.heappush(best, (-dist, next(counter), node))
+                else:
+                    heapq.heapreplace(best, (-dist, next(counter), node))
+                if len(best) == k:
+                    limit = -best[0][0]
+
+            axis_diff = point[node.axis] - data[node.axis]
+            if axis_diff < 0:
+                near, far = node.left, node.right
+            else:
+                near, far = node.right, node.left
+
+            # the far side is pushed first so the near side is visited first
+            if far is not None and far.data is not None:
+                stack.append((far, max(region_dist, axis_diff ** 2)))
+            if near is not None and near.data is not None:
+                stack.append((near, region_dist))
+
+        return [(node, -neg_dist) for neg_dist, _, node in sorted(best, reverse=True)]
+
+
+    @require_axis
+    def search_nn(self, point, best=None, max_distance=None):
         """
         Search the nearest node of the given point
 
         point must be a location, not a node. The nearest node to the point is
         returned. If a location of an actual node is used, the Node with this
-        location will be retuend (not its neighbor) """
+        location will be retuend (not its neighbor). best optionally is a node
+        that is returned if nothing closer is found. None is returned if no
+        node is closer than max_distance. """
 
-        current = self
-        while True:
-            if best is None:
-                best = current
+        result = self.search_knn(point, 1, max_distance)
+        if best is not None:
+            result.append((best, best.dist(point)))
+        if not result:
+            return None
+        return min(result, key=lambda node_dist: node_dist[1])[0]
 
-            # consider the current node
-            if current.dist(point) < best.dist(point):
-                best = current
 
-            # sort the children, nearer one first
-            children = iter(sorted(current.children,
-                key=lambda c_p: c_p[0].axis_dist(point, current.axis)))
+    @require_axis
+    def search_nn_batch(self, points, max_distance=None):
+        """
+        Search the nearest node of each of the given points
 
-            c1, _ = next(children, (None, None))
-            if c1:
-                current = c1
-                continue
+        A list with one node per point, or None where no node is closer than
+        max_distance, is returned. """
 
-            c2, _ = next(children, (None, None))
-            if c2 and current.axis_dist(point, current.axis) < best.dist(point):
-                current = c2
-                continue
+        return [self.search_nn(point, max_distance=max_distance) for point in points]
 
-            return best
 
     @require_axis
     def search_nn_dist(self, point, distance, best=None):
@@ -432,24 +495,41 @@ class KDNode(Node):
         Search the n nearest nodes of the given point which are within given
         distance
 
-        point must be a location, not a node. A list containing the n nearest
-        nodes to the point within the distance will be returned.
+        point must be a location, not a node. A list containing the nodes
+        closer than distance (not squared) to the point will be returned,
+        appended to best if it is given.
+
+        The tree is walked with an explicit stack, and only the far side of a
+        split that is farther than distance from the point is skipped.
         """
 
         if best is None:
             best = []
 
-        # consider the current node
-        if self.dist(point) < distance:
-            best.append(self)
+        limit = distance ** 2
+        dimensions = range(len(point))
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            data = node.data
 
-        # sort the children, nearer one first (is this really necessairy?)
-        children = sorted(self.children, key=lambda c_p1: c_p1[0].dist(point))
+            dist = 0.0
+            for i in dimensions:
+                dist += (data[i] - point[i]) ** 2
+            if dist < limit:
+                best.append(node)
+
+            axis_diff = point[node.axis] - data[node.axis]
+            if axis_diff < 0:
+                near, far = node.left, node.right
+            else:
+                near, far = node.right, node.left
 
-        for child, p in children:
-            # check if child node needs to be recursed
-            if self.axis_dist(point, self.axis) < math.pow(distance, 2):
-                child.search_nn_dist(point, distance, best)
+            if far is not None and far.data is not None and axis_diff ** 2 < limit:
+                stack.append(far)
+            if near is not None and near.data is not None:
+                stack.append(near)
 
         return best
 
@@ -534,6 +614,473 @@ def create(point_list=None, dimensions=None, axis=0, sel_axis=None):
     return KDNode(loc, left, right, axis=axis, sel_axis=sel_axis)
 
 
+def create_from_array(points, aux=None, axis=0, sel_axis=None):
+    """ Creates a balanced kd-tree from an array of points in one pass
+
+    points is a (n, dimensions) numpy array. aux optionally holds one payload
+    row per point, which is stored as a tuple on the node of that point.
+
+    Instead of adding the points one by one, every subtree is split at its
+    median (see median_split), so the tree is balanced whatever order the
+    points arrive in. """
+
+    points = np.asarray(points)
+    dimensions = points.shape[1]
+    sel_axis = sel_axis or (lambda prev_axis: (prev_axis+1) % dimensions)
+
+    if len(points) == 0:
+        return KDNode(sel_axis=sel_axis, axis=axis, dimensions=dimensions)
+
+    order, axes = median_split(points, axis, sel_axis)
+
+    data = [tuple(p) for p in points[order].tolist()]
+    if aux is not None:
+        aux = [tuple(a) for a in np.asarray(aux)[order].tolist()]
+    else:
+        aux = [None] * len(data)
+
+    nodes = []
+    level_start = 0
+    for level_axis in axes:
+        level_end = min(2 * level_start + 1, len(data))
+        for i in range(level_start, level_end):
+            nodes.append(KDNode(data[i], aux[i], axis=level_axis,
+                sel_axis=sel_axis, dimensions=dimensions))
+        level_start = level_end
+
+    for i in range(len(nodes) // 2):
+        nodes[i].left = nodes[2 * i + 1]
+        if 2 * i + 2 < len(nodes):
+            nodes[i].right = nodes[2 * i + 2]
+
+    return nodes[0]
+
+
+def _left_subtree_size(sizes):
+    """ Size of the left subtree of left-complete binary trees of the given
+    sizes """
+
+    # floor(log2(size)), exact for integers
+    height = np.frexp(sizes)[1] - 1
+    last_level_capacity = np.left_shift(1, np.maximum(height - 1, 0))
+    last_level = sizes - (np.left_shift(1, height) - 1)
+    left = (last_level_capacity - 1) + np.minimum(last_level, last_level_capacity)
+    return np.where(sizes > 1, left, 0)
+
+
+def median_split(points, axis=0, sel_axis=None):
+    """ Sorts an array of points into a balanced kd-tree
+
+    The tree is left-complete and stored in level order, so the children of
+    node i are nodes 2*i+1 and 2*i+2. Every level is split at once: the
+    points of all subtrees of a level are sorted by (subtree, coordinate)
+    and the median of each subtree becomes its root.
+
+    Returns (order, axes) where order[i] is the index into points of node i
+    and axes[level] is the split axis of that level of the tree. """
+
+    points = np.asarray(points)
+    dimensions = points.shape[1]
+    sel_axis = sel_axis or (lambda prev_axis: (prev_axis+1) % dimensions)
+
+    count = len(points)
+    if count == 0:
+        return np.zeros(0, dtype=np.intp), []
+    remaining = np.arange(count)
+
+    # unique integer ranks along every axis make (subtree, rank) a single
+    # exact integer sort key
+    ranks = np.empty(points.shape, dtype=np.int64)
+    for dimension in range(dimensions):
+        ranks[np.argsort(points[:, dimension], kind='mergesort'), dimension] = np.arange(count)
+    order = np.empty(count, dtype=np.intp)
+    axes = []
+
+    # contiguous ranges of "remaining" that form the subtrees of this level
+    starts = np.zeros(1, dtype=np.intp)
+    sizes = np.array([count], dtype=np.intp)
+    heap_index = np.zeros(1, dtype=np.intp)
+    level_axis = axis
+
+    while len(sizes) > 0:
+        axes.append(level_axis)
+
+        subtree = np.repeat(np.arange(len(sizes)), sizes)
+        perm = np.argsort(subtree * count + ranks[remaining, level_axis], kind='mergesort')
+        remaining = remaining[perm]
+
+        left_sizes = _left_subtree_size(sizes)
+        medians = starts + left_sizes
+        order[heap_index] = remaining[medians]
+
+        # drop the medians, the remaining points of each subtree stay contiguous
+        keep = np.ones(len(remaining), dtype=bool)
+        keep[medians] = False
+        remaining = remaining[keep]
+        new_starts = starts - np.arange(len(starts))
+
+        right_sizes = sizes - left_sizes - 1
+        starts = np.column_stack((new_starts, new_starts + left_sizes)).ravel()
+        sizes = np.column_stack((left_sizes, right_sizes)).ravel()
+        heap_index = np.column_stack((2 * heap_index + 1, 2 * heap_index + 2)).ravel()
+
+        nonempty = sizes > 0
+        starts, sizes, heap_index = starts[nonempty], sizes[nonempty], heap_index[nonempty]
+        level_axis = sel_axis(level_axis)
+
+    return order, axes
+
+
+class FlatKDTree(object):
+    """ A kd-tree stored in flat numpy arrays
+
+    The tree is built in one pass by median_split and is left-complete, so
+    the children of node i are nodes 2*i+1 and 2*i+2 and no child pointers
+    are stored. The split axis of a node only depends on its level. Per node
+    the tree keeps its point, the index of that point in the array the tree
+    was built from and, optionally, an aux payload row.
+
+    As all members are plain arrays, the tree pickles cheaply.
+
+    The batch searches walk the tree for many points at once with a frontier
+    of (point, node) pairs. At most frontier_limit pairs are expanded at a
+    time, the rest wait on a stack, so a poorly pruned search (e.g. on
+    points that all lie on a thin curve) takes longer instead of exhausting
+    memory. """
+
+    frontier_limit = 1 << 18
+
+    def __init__(self, points, aux=None, axis=0, sel_axis=None):
+        points = np.asarray(points)
+        if points.ndim != 2:
+            raise ValueError('points must be a (n, dimensions) array')
+
+        order, axes = median_split(points, axis, sel_axis)
+        index_type = np.int32 if len(points) < 2**31 else np.int64
+
+        self.data = np.ascontiguousarray(points[order])
+        self.indices = order.astype(index_type)
+        self.aux = np.asarray(aux)[order] if aux is not None else None
+        self.level_axes = np.array(axes, dtype=np.uint8)
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    @property
+    def dimensions(self):
+        return self.data.shape[1]
+
+
+    @property
+    def nbytes(self):
+        """ Number of bytes held by the arrays of the tree """
+
+        arrays = [self.data, self.indices, self.level_axes]
+        if self.aux is not None:
+            arrays.append(self.aux)
+        return sum(a.nbytes for a in arrays)
+
+
+    def height(self):
+        """ Returns height of the tree
+
+        >>> FlatKDTree([ (1, 2), (2, 3) ]).height()
+        2
+        """
+
+        return len(self.level_axes)
+
+
+    def node_axes(self, nodes):
+        """ Split axis of each of the given nodes """
+
+        levels = np.frexp(np.asarray(nodes) + 1)[1] - 1
+        return self.level_axes[levels]
+
+
+    def search_nn_batch(self, points, chunk_size=65536):
+        """
+        Search the nearest node of each of the given points
+
+        points is a (n, dimensions) array. Returns (dist, nodes) arrays, where
+        dist is the squared distance to the nearest node. Use nodes to index
+        data, indices or aux. All points of a chunk are searched together
+        with vectorized operations. """
+
+        points = np.asarray(points, dtype=np.float64)
+        count = len(points)
+        best_dist = np.empty(count, dtype=np.float64)
+        best_node = np.empty(count, dtype=np.intp)
+
+        for start in range(0, count, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            best_dist[chunk], best_node[chunk] = self._search_nn_chunk(points[chunk])
+
+        return best_dist, best_node
+
+
+    def _search_nn_chunk(self, points):
+        size = len(self.data)
+        count = len(points)
+        if size == 0:
+            return np.full(count, np.inf), np.full(count, -1, dtype=np.intp)
+        queries = np.arange(count)
+
+        # descend to a leaf first, which usually gives a close match and
+        # lets the backtracking below prune most of the tree
+        best_dist = np.full(count, np.inf)
+        best_node = np.zeros(count, dtype=np.intp)
+        nodes = np.zeros(count, dtype=np.intp)
+        active = queries
+        while len(active) > 0:
+            self._visit(points, active, nodes, best_dist, best_node)
+            axes = self.node_axes(nodes)
+            go_right = points[active, axes] >= self.data[nodes, axes]
+            nodes = 2 * nodes + 1 + go_right
+            inside = nodes < size
+            active, nodes = active[inside], nodes[inside]
+
+        # visit every node whose region may hold a closer point, all queries
+        # at once, one level of the tree per iteration
+        active = queries
+        nodes = np.zeros(count, dtype=np.intp)
+        bounds = np.zeros(count)
+        pending = []
+        while len(active) > 0 or pending:
+            active, nodes, bounds = self._split_frontier((active, nodes, bounds), pending)
+            keep = bounds < best_dist[active]
+            active, nodes, bounds = active[keep], nodes[keep], bounds[keep]
+
+            self._visit(points, active, nodes, best_dist, best_node)
+
+            axes = self.node_axes(nodes)
+            axis_diff = points[active, axes] - self.data[nodes, axes]
+            far_bounds = np.maximum(bounds, axis_diff ** 2)
+            left_bounds = np.where(axis_diff < 0, bounds, far_bounds)
+            right_bounds = np.where(axis_diff < 0, far_bounds, bounds)
+
+            active = np.concatenate((active, active))
+            nodes = np.concatenate((2 * nodes + 1, 2 * nodes + 2))
+            bounds = np.concatenate((left_bounds, right_bounds))
+            inside = (nodes < size) & (bounds < best_dist[active])
+            active, nodes, bounds = active[inside], nodes[inside], bounds[inside]
+
+        return best_dist, best_node
+
+
+    def search_knn_batch(self, points, k, max_distance=None, chunk_size=16384):
+        """
+        Search the k nearest nodes of each of the given points
+
+        Returns (dist, nodes) arrays of shape (n, k), nearest first, where
+        dist is the squared distance. Only nodes closer than max_distance (not
+        squared) are considered; missing neighbours have an infinite
+        distance and node -1. """
+
+        if k < 1:
+            raise ValueError('k must be at least 1')
+
+        points = np.asarray(points, dtype=np.float64)
+        count = len(points)
+        limit = np.inf if max_distance is None else float(max_distance) ** 2
+        best_dist = np.empty((count, k), dtype=np.float64)
+        best_node = np.empty((count, k), dtype=np.intp)
+
+        for start in range(0, count, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            best_dist[chunk], best_node[chunk] = self._search_knn_chunk(points[chunk], k, limit)
+
+        return best_dist, best_node
+
+
+    def _search_knn_chunk(self, points, k, limit):
+        size = len(self.data)
+        count = len(points)
+
+        # row q holds the k best (dist, node) of query q, sorted
+        best_dist = np.full((count, k), limit)
+        best_node = np.full((count, k), -1, dtype=np.intp)
+        if size == 0:
+            best_dist[:] = np.inf
+            return best_dist, best_node
+
+        # descend to a leaf first to find close candidates for pruning
+        active = np.arange(count)
+        nodes = np.zeros(count, dtype=np.intp)
+        while len(active) > 0:
+            dist = ((points[active] - self.data[nodes]) ** 2).sum(axis=1)
+            self._merge_knn(best_dist, best_node, active, dist, nodes)
+            axes = self.node_axes(nodes)
+            go_right = points[active, axes] >= self.data[nodes, axes]
+            nodes = 2 * nodes + 1 + go_right
+            inside = nodes < size
+            active, nodes = active[inside], nodes[inside]
+
+        # visit every node whose region may hold a closer point, skipping the
+        # nodes of the descent above
+        active = np.arange(count)
+        nodes = np.zeros(count, dtype=np.intp)
+        bounds = np.zeros(count)
+        on_path = np.ones(count, dtype=bool)
+        pending = []
+        while len(active) > 0 or pending:
+            active, nodes, bounds, on_path = self._split_frontier((active, nodes, bounds, on_path), pending)
+            keep = bounds < best_dist[active, -1]
+            active, nodes, bounds, on_path = active[keep], nodes[keep], bounds[keep], on_path[keep]
+
+            visit = ~on_path
+            dist = ((points[active[visit]] - self.data[nodes[visit]]) ** 2).sum(axis=1)
+            self._merge_knn(best_dist, best_node, active[visit], dist, nodes[visit])
+
+            axes = self.node_axes(nodes)
+            axis_diff = points[active, axes] - self.data[nodes, axes]
+            far_bounds = np.maximum(bounds, axis_diff ** 2)
+            go_left = axis_diff < 0
+            left_bounds = np.where(go_left, bounds, far_bounds)
+            right_bounds = np.where(go_left, far_bounds, bounds)
+
+            active = np.concatenate((active, active))
+            nodes = np.concatenate((2 * nodes + 1, 2 * nodes + 2))
+            bounds = np.concatenate((left_bounds, right_bounds))
+            on_path = np.concatenate((on_path & go_left, on_path & ~go_left))
+            inside = (nodes < size) & (bounds < best_dist[active, -1])
+            active, nodes, bounds, on_path = active[inside], nodes[inside], bounds[inside], on_path[inside]
+
+        best_dist[best_node < 0] = np.inf
+        return best_dist, best_node
+
+
+    @staticmethod
+    def _merge_knn(best_dist, best_node, queries, dist, nodes):
+        """ Merges candidate (dist, node) pairs, none of which is in the k
+        best rows yet, into the sorted k best rows of their queries """
+
+        k = best_dist.shape[1]
+        closer = dist < best_dist[queries, -1]
+        queries, dist, nodes = queries[closer], dist[closer], nodes[closer]
+        if len(queries) == 0:
+            return
+
+        # lay the candidates of every touched query out in a padded row
+        order = np.argsort(queries, kind='mergesort')
+        queries, dist, nodes = queries[order], dist[order], nodes[order]
+        touched, group_starts, group_sizes = np.unique(queries, return_index=True, return_counts=True)
+        column = np.arange(len(queries)) - np.repeat(group_starts, group_sizes)
+        row = np.repeat(np.arange(len(touched)), group_sizes)
+
+        width = k + group_sizes.max()
+        merged_dist = np.full((len(touched), width), np.inf)
+        merged_node = np.full((len(touched), width), -1, dtype=np.intp)
+        merged_dist[:, :k] = best_dist[touched]
+        merged_node[:, :k] = best_node[touched]
+        merged_dist[row, k + column] = dist
+        merged_node[row, k + column] = nodes
+
+        best = np.argsort(merged_dist, axis=1, kind='mergesort')[:, :k]
+        best_dist[touched] = np.take_along_axis(merged_dist, best, axis=1)
+        best_node[touched] = np.take_along_axis(merged_node, best, axis=1)
+
+
+    def search_nn_dist_batch(self, points, distance, chunk_size=65536):
+        """
+        Search the nodes within distance (not squared) of each of the given
+        points
+
+        The result is returned in a compressed sparse row layout as
+        (offsets, nodes, dist): the neighbours of point i are
+        nodes[offsets[i]:offsets[i+1]], nearest first, and dist holds their
+        squared distances. The tree is walked for all points at once with a
+        frontier of (point, node) pairs instead of recursion. """
+
+        points = np.asarray(points, dtype=np.float64)
+        count = len(points)
+        limit = float(distance) ** 2
+
+        counts = np.zeros(count, dtype=np.intp)
+        found_nodes = []
+        found_dist = []
+        for start in range(0, count, chunk_size):
+            queries, nodes, dist = self._search_nn_dist_chunk(points[start:start + chunk_size], limit)
+            counts[start:start + chunk_size] = np.bincount(queries, minlength=min(chunk_size, count - start))
+            found_nodes.append(nodes)
+            found_dist.append(dist)
+
+        offsets = np.zeros(count + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        nodes = np.concatenate(found_nodes) if found_nodes else np.zeros(0, dtype=np.intp)
+        dist = np.concatenate(found_dist) if found_dist else np.zeros(0)
+        return offsets, nodes, dist
+
+
+    def _search_nn_dist_chunk(self, points, limit):
+        size = len(self.data)
+        count = len(points)
+
+        found_queries = []
+        found_nodes = []
+        found_dist = []
+        if size == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+
+        active = np.arange(count)
+        nodes = np.zeros(count, dtype=np.intp)
+        bounds = np.zeros(count)
+        pending = []
+        while len(active) > 0 or pending:
+            active, nodes, bounds = self._split_frontier((active, nodes, bounds), pending)
+            dist = ((points[active] - self.data[nodes]) ** 2).sum(axis=1)
+            within = dist < limit
+            found_queries.append(active[within])
+            found_nodes.append(nodes[within])
+            found_dist.append(dist[within])
+
+            axes = self.node_axes(nodes)
+            axis_diff = points[active, axes] - self.data[nodes, axes]
+            far_bounds = np.maximum(bounds, axis_diff ** 2)
+            left_bounds = np.where(axis_diff < 0, bounds, far_bounds)
+            right_bounds = np.where(axis_diff < 0, far_bounds, bounds)
+
+            active = np.concatenate((active, active))
+            nodes = np.concatenate((2 * nodes + 1, 2 * nodes + 2))
+            bounds = np.concatenate((left_bounds, right_bounds))
+            inside = (nodes < size) & (bounds < limit)
+            active, nodes, bounds = active[inside], nodes[inside], bounds[inside]
+
+        queries = np.concatenate(found_queries)
+        nodes = np.concatenate(found_nodes)
+        dist = np.concatenate(found_dist)
+        order = np.lexsort((dist, queries))
+        return queries[order], nodes[order], dist[order]
+
+
+    def _split_frontier(self, frontier, pending):
+        """ Returns the part of the frontier to expand next
+
+        Pairs beyond frontier_limit are set aside on the pending stack and
+        taken back once the frontier runs dry. They are expanded after the
+        pairs kept, so they profit from the closer matches found by then. """
+
+        if len(frontier[0]) > self.frontier_limit:
+            pending.append(tuple(array[self.frontier_limit:] for array in frontier))
+            return tuple(array[:self.frontier_limit] for array in frontier)
+        if len(frontier[0]) == 0 and pending:
+            return pending.pop()
+        return frontier
+
+
+    def _visit(self, points, active, nodes, best_dist, best_node):
+        """ Updates the best matches of the active queries with the given
+        nodes, one node per query """
+
+        dist = ((points[active] - self.data[nodes]) ** 2).sum(axis=1)
+        np.minimum.at(best_dist, active, dist)
+        closer = dist == best_dist[active]
+        best_node[active[closer]] = nodes[closer]
+
+
+
 def check_dimensionality(point_list, dimensions=None):
     dimensions = dimensions or len(point_list[0])
     for p in point_list:
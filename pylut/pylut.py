@@ -3,14 +3,59 @@
 
 
 import os
+import re
 import math
+import multiprocessing
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import kdtree
 from progress.bar import Bar
 import struct
+import json
+import hashlib
+import functools
+import tempfile
+from collections import OrderedDict
 
-def EmptyLatticeOfSize(cubeSize):
-	return np.zeros((cubeSize, cubeSize, cubeSize), object)
+INTERPOLATION_TRILINEAR = "trilinear"
+INTERPOLATION_TETRAHEDRAL = "tetrahedral"
+INTERPOLATION_NEAREST = "nearest"
+
+APPLY_TILE_SIZE = 16384
+
+FRAME_CHUNK_SIZE = 1 << 18
+
+BINARY_EXTENSION = ".plut"
+BINARY_MAGIC = b"\x93PYLUT"
+BINARY_VERSION = 1
+_BINARY_PREFIX = struct.Struct("<BBI")
+_BINARY_ALIGNMENT = 64
+
+MAX_INTEGER_TABLE_BYTES = 1 << 30
+MAX_DEFAULT_TABLE_BITDEPTH = 8
+
+MAX_CACHED_IDENTITY_SIZE = 65
+_identityLattices = {}
+
+def EmptyLatticeOfSize(cubeSize, dtype = np.float64):
+	"""
+	Creates a zeroed (cubeSize, cubeSize, cubeSize, 3) lattice. The last axis holds the red, green and blue values of each lattice point.
+	"""
+	return np.zeros((cubeSize, cubeSize, cubeSize, 3), dtype)
+
+def LatticeFromColorLattice(colorLattice, dtype = np.float64):
+	"""
+	Converts a (cubeSize, cubeSize, cubeSize) object array of Color instances to a numeric lattice.
+	"""
+	cubeSize = colorLattice.shape[0]
+	lattice = EmptyLatticeOfSize(cubeSize, dtype)
+	for r in xrange(cubeSize):
+		for g in xrange(cubeSize):
+			for b in xrange(cubeSize):
+				lattice[r, g, b] = colorLattice[r, g, b].ToFloatArray()
+	return lattice
 
 def Indices01(cubeSize):
 	indices = []
@@ -79,6 +124,566 @@ def ToIntArray(string):
 		array.append(ord(x))
 	return array
 
+def _SplitHeaderAndBody(text):
+	"""
+	Used internally to split the text of a .cube or .3dl file into a dictionary of header keywords and the text of the numeric body, which starts at the first line beginning with a number.
+	Header values are kept as lists of string tokens, except TITLE which is unquoted.
+	"""
+	header = {}
+	lineStart = 0
+	textLength = len(text)
+	while lineStart < textLength:
+		lineEnd = text.find("\n", lineStart)
+		if lineEnd == -1:
+			lineEnd = textLength
+		tokens = text[lineStart:lineEnd].split()
+		if len(tokens) > 0 and not tokens[0].startswith("#"):
+			try:
+				float(tokens[0])
+				break
+			except ValueError:
+				pass
+			if tokens[0] == "TITLE":
+				header["TITLE"] = text[lineStart:lineEnd].split(None, 1)[1].strip().strip('"') if len(tokens) > 1 else ""
+			else:
+				header[tokens[0]] = tokens[1:]
+		lineStart = lineEnd + 1
+	return header, text[lineStart:]
+
+_NON_NUMERIC_PATTERN = re.compile(r"[^0-9eE+\-.\s]")
+
+def _ParseTriplets(body, dtype = np.float64):
+	"""
+	Used internally to decode whitespace separated RGB triplets into an (N, 3) array in one step.
+	Lines that do not hold exactly 3 values or contain a comment are skipped.
+	"""
+	match = _NON_NUMERIC_PATTERN.search(body)
+	if match is not None:
+		# only the lines from the first non-numeric character on need to be filtered one by one
+		lineStart = body.rfind("\n", 0, match.start()) + 1
+		tail = [line for line in body[lineStart:].splitlines() if len(line.split()) == 3 and "#" not in line]
+		body = body[:lineStart] + "\n".join(tail)
+	values = np.fromstring(body, dtype = dtype, sep = " ")
+	if values.size % 3 != 0:
+		body = "\n".join([line for line in body.splitlines() if len(line.split()) == 3])
+		values = np.fromstring(body, dtype = dtype, sep = " ")
+	return values.reshape(-1, 3)
+
+def _LatticeFrom3DLBody(body, cubeSize, outputDepth, dtype):
+	"""
+	Used internally to decode the integer triplets of a .3dl file, ordered with blue changing fastest, into a normalized lattice.
+	"""
+	points = _ParseTriplets(body, np.int64)
+	if points.shape[0] != cubeSize**3:
+		raise NameError("Invalid .3dl file. Expected " + str(cubeSize**3) + " points, found " + str(points.shape[0]) + ".")
+	lattice = points.reshape(cubeSize, cubeSize, cubeSize, 3).astype(dtype)
+	lattice /= lattice.dtype.type(2**outputDepth - 1)
+	return lattice
+
+def _WriteFormattedRows(outFile, rows, rowFormat, chunkSize = 65536):
+	"""
+	Used internally to write an (N, 3) array as text, one rowFormat line per row separated by newlines, in chunks of chunkSize rows.
+	"""
+	rowCount = rows.shape[0]
+	for chunkStart in xrange(0, rowCount, chunkSize):
+		chunk = rows[chunkStart:chunkStart + chunkSize]
+		chunkFormat = "\n".join([rowFormat] * chunk.shape[0])
+		if chunkStart > 0:
+			outFile.write("\n")
+		outFile.write(chunkFormat % tuple(chunk.ravel().tolist()))
+
+def _GridPoints(axisValues):
+	"""
+	Used internally to list every (red, green, blue) combination of axisValues as an (N, 3) array, blue changing fastest.
+	"""
+	return np.stack(np.meshgrid(axisValues, axisValues, axisValues, indexing = 'ij'), axis = -1).reshape(-1, 3)
+
+def IdentityLattice(cubeSize, dtype = np.float64):
+	"""
+	Returns a read-only identity lattice, where lattice[r, g, b] is (r, g, b) / (cubeSize-1). Reshaped to (N, 3) it lists the normalized coordinates of every lattice point, blue changing fastest.
+	Lattices up to MAX_CACHED_IDENTITY_SIZE are built once per size and dtype and shared.
+	"""
+	key = (cubeSize, np.dtype(dtype))
+	lattice = _identityLattices.get(key)
+	if lattice is None:
+		# same values as Indices01
+		indices01 = np.arange(cubeSize, dtype = np.float64) * (1.0 / float(cubeSize - 1))
+		lattice = _GridPoints(indices01.astype(dtype)).reshape(cubeSize, cubeSize, cubeSize, 3)
+		lattice.setflags(write = False)
+		if cubeSize <= MAX_CACHED_IDENTITY_SIZE:
+			_identityLattices[key] = lattice
+	return lattice
+
+def _ReverseSlab(tree, redIndex, cubeSize, sampleSize, neighbors):
+	"""
+	Used internally by Reverse to find the inputs for the (cubeSize, cubeSize) slab of the reversed lattice at redIndex.
+	"""
+	axisValues = np.arange(cubeSize, dtype = np.float64) / float(cubeSize - 1)
+	targets = np.empty((cubeSize, cubeSize, 3), np.float64)
+	targets[:, :, 0] = axisValues[redIndex]
+	targets[:, :, 1] = axisValues[:, np.newaxis]
+	targets[:, :, 2] = axisValues[np.newaxis, :]
+	targets = targets.reshape(-1, 3)
+
+	if neighbors > 1:
+		dist, nodes = tree.search_knn_batch(targets, neighbors)
+	else:
+		dist, nodes = tree.search_nn_batch(targets)
+		dist, nodes = dist[:, np.newaxis], nodes[:, np.newaxis]
+	return redIndex, _BlendSampleInputs(tree.indices[nodes], dist, sampleSize).reshape(cubeSize, cubeSize, 3)
+
+_reverseWorkerState = {}
+
+def _InitReverseWorker(tree, cubeSize, sampleSize, neighbors):
+	"""
+	Used internally as the pool initializer of Reverse so every worker process receives the search tree once.
+	"""
+	_reverseWorkerState["arguments"] = (tree, cubeSize, sampleSize, neighbors)
+
+def _ReverseWorkerSlab(redIndex):
+	tree, cubeSize, sampleSize, neighbors = _reverseWorkerState["arguments"]
+	return _ReverseSlab(tree, redIndex, cubeSize, sampleSize, neighbors)
+
+def _BlendSampleInputs(sampleIndices, squaredDistances, sampleSize):
+	"""
+	Used internally by Reverse to turn (N, k) indices into a sample grid of sampleSize, blue changing fastest, into input colors, blending the k neighbors of each row by inverse distance.
+	"""
+	inputs = np.stack(np.unravel_index(sampleIndices, (sampleSize, sampleSize, sampleSize)), axis = -1) / float(sampleSize - 1)
+	if sampleIndices.shape[1] == 1:
+		return inputs[:, 0]
+
+	weights = 1.0 / np.maximum(np.sqrt(squaredDistances), 1e-12)
+	# an exact match gets all of the weight
+	exact = squaredDistances[:, 0] == 0
+	weights[exact] = 0.0
+	weights[exact, 0] = 1.0
+	weights /= weights.sum(axis = 1)[:, np.newaxis]
+	return (inputs * weights[:, :, np.newaxis]).sum(axis = 1)
+
+def _ForwardJacobian(function, inputs, stepSize = 1e-4):
+	"""
+	Used internally to estimate the (N, 3, 3) Jacobians of a function of (N, 3) points in 0-1 with forward differences, stepping backwards at the top of the range.
+	"""
+	outputs = function(inputs)
+	jacobians = np.empty(inputs.shape + (3,), np.float64)
+	for channel in xrange(3):
+		steps = np.where(inputs[:, channel] + stepSize > 1.0, -stepSize, stepSize)
+		shifted = inputs.copy()
+		shifted[:, channel] += steps
+		jacobians[:, :, channel] = (function(shifted) - outputs) / steps[:, np.newaxis]
+	return jacobians
+
+def _SolveLinear3x3(matrices, vectors):
+	"""
+	Used internally to solve (N, 3, 3) linear systems by their adjugates. Singular systems fall back to returning the vector unchanged.
+	"""
+	a, b, c = matrices[:, 0, 0], matrices[:, 0, 1], matrices[:, 0, 2]
+	d, e, f = matrices[:, 1, 0], matrices[:, 1, 1], matrices[:, 1, 2]
+	g, h, i = matrices[:, 2, 0], matrices[:, 2, 1], matrices[:, 2, 2]
+	adjugate = np.empty(matrices.shape, np.float64)
+	adjugate[:, 0, 0] = e*i - f*h
+	adjugate[:, 0, 1] = c*h - b*i
+	adjugate[:, 0, 2] = b*f - c*e
+	adjugate[:, 1, 0] = f*g - d*i
+	adjugate[:, 1, 1] = a*i - c*g
+	adjugate[:, 1, 2] = c*d - a*f
+	adjugate[:, 2, 0] = d*h - e*g
+	adjugate[:, 2, 1] = b*g - a*h
+	adjugate[:, 2, 2] = a*e - b*d
+	determinant = a * adjugate[:, 0, 0] + b * adjugate[:, 1, 0] + c * adjugate[:, 2, 0]
+
+	singular = np.abs(determinant) < 1e-12
+	determinant[singular] = 1.0
+	solution = np.einsum('nij,nj->ni', adjugate, vectors) / determinant[:, np.newaxis]
+	solution[singular] = vectors[singular]
+	return solution
+
+def _ScratchArray(scratch, name, shape, dtype):
+	"""
+	Used internally to get a work array for the interpolation kernels. When a scratch dictionary is given, its arrays are reused by later calls instead of allocating new ones.
+	"""
+	if scratch is None:
+		return np.empty(shape, dtype)
+	size = int(np.prod(shape))
+	buffer = scratch.get(name)
+	if buffer is None or buffer.size < size or buffer.dtype != dtype:
+		buffer = np.empty(size, dtype)
+		scratch[name] = buffer
+	return buffer[:size].reshape(shape)
+
+def _LatticeCellsAndFractions(cubeSize, points, scratch = None):
+	"""
+	Used internally to split (N, 3) lattice coordinates into the flat index of the lower corner of each containing cell and the fractional position inside it.
+	"""
+	fractions = _ScratchArray(scratch, "fractions", points.shape, points.dtype)
+	lower = _ScratchArray(scratch, "lower", points.shape, np.intp)
+	np.floor(points, out = fractions)
+	np.copyto(lower, fractions, casting = 'unsafe')
+	np.clip(lower, 0, max(cubeSize - 2, 0), out = lower)
+	np.subtract(points, lower, out = fractions, casting = 'unsafe')
+
+	cells = _ScratchArray(scratch, "cells", points.shape[:1], np.intp)
+	np.multiply(lower[:, 0], cubeSize, out = cells)
+	cells += lower[:, 1]
+	cells *= cubeSize
+	cells += lower[:, 2]
+	return cells, fractions
+
+def _LerpInPlace(beginning, end, value01):
+	"""
+	Used internally to lerp two (N, 3) arrays, storing the result in beginning. end is used as scratch space.
+	"""
+	np.subtract(end, beginning, out = end)
+	np.multiply(end, value01, out = end)
+	np.add(beginning, end, out = beginning)
+	return beginning
+
+def TrilinearInterpolation(lattice, points, out = None, scratch = None):
+	"""
+	Trilinearly interpolates an (N, 3) array of float lattice coordinates (0 to cubeSize-1) against a (cubeSize, cubeSize, cubeSize, 3) lattice.
+	Returns an (N, 3) array, written into out if it is given. scratch is an optional dictionary of reusable work arrays.
+	"""
+	cubeSize = lattice.shape[0]
+	flatLattice = lattice.reshape(-1, 3)
+	cells, fractions = _LatticeCellsAndFractions(cubeSize, points, scratch)
+	redStep = cubeSize * cubeSize
+	greenStep = cubeSize
+	cornerCells = _ScratchArray(scratch, "cornerCells", cells.shape, np.intp)
+
+	def Corner(offset, name):
+		np.add(cells, offset, out = cornerCells)
+		return np.take(flatLattice, cornerCells, axis = 0, out = _ScratchArray(scratch, name, points.shape, lattice.dtype))
+
+	fr = fractions[:, 0:1]
+	fg = fractions[:, 1:2]
+	fb = fractions[:, 2:3]
+
+	C00 = _LerpInPlace(Corner(0, "C00"), Corner(redStep, "end"), fr)
+	C10 = _LerpInPlace(Corner(greenStep, "C10"), Corner(redStep + greenStep, "end"), fr)
+	C01 = _LerpInPlace(Corner(1, "C01"), Corner(redStep + 1, "end"), fr)
+	C11 = _LerpInPlace(Corner(greenStep + 1, "C11"), Corner(redStep + greenStep + 1, "end"), fr)
+
+	C0 = _LerpInPlace(C00, C10, fg)
+	C1 = _LerpInPlace(C01, C11, fg)
+
+	_LerpInPlace(C0, C1, fb)
+	if out is None:
+		return C0.copy() if scratch is not None else C0
+	out[...] = C0
+	return out
+
+def TetrahedralInterpolation(lattice, points, out = None, scratch = None):
+	"""
+	Tetrahedrally interpolates an (N, 3) array of float lattice coordinates (0 to cubeSize-1) against a (cubeSize, cubeSize, cubeSize, 3) lattice.
+	Each cell is split into 6 tetrahedra along its black-white diagonal, so only 4 corners are blended per point.
+	Returns an (N, 3) array, written into out if it is given. scratch is an optional dictionary of reusable work arrays.
+	"""
+	cubeSize = lattice.shape[0]
+	flatLattice = lattice.reshape(-1, 3)
+	cells, fractions = _LatticeCellsAndFractions(cubeSize, points, scratch)
+	count = cells.shape[0]
+	redStep = cubeSize * cubeSize
+	greenStep = cubeSize
+	blueStep = 1
+
+	fr = fractions[:, 0]
+	fg = fractions[:, 1]
+	fb = fractions[:, 2]
+	redOverGreen = np.greater_equal(fr, fg, out = _ScratchArray(scratch, "redOverGreen", (count,), np.bool_))
+	greenOverBlue = np.greater_equal(fg, fb, out = _ScratchArray(scratch, "greenOverBlue", (count,), np.bool_))
+	redOverBlue = np.greater_equal(fr, fb, out = _ScratchArray(scratch, "redOverBlue", (count,), np.bool_))
+	mask = _ScratchArray(scratch, "mask", (count,), np.bool_)
+
+	# walk from the black corner of the cell to the white corner, stepping along the axis with the largest fraction first
+	largestStep = _ScratchArray(scratch, "largestStep", (count,), np.intp)
+	largestStep.fill(blueStep)
+	np.copyto(largestStep, greenStep, where = greenOverBlue)
+	np.copyto(largestStep, redStep, where = np.logical_and(redOverGreen, redOverBlue, out = mask))
+
+	smallestStep = _ScratchArray(scratch, "smallestStep", (count,), np.intp)
+	smallestStep.fill(greenStep)
+	np.copyto(smallestStep, blueStep, where = np.logical_and(redOverBlue, greenOverBlue, out = mask))
+	np.copyto(smallestStep, redStep, where = np.logical_not(np.logical_or(redOverGreen, redOverBlue, out = mask), out = mask))
+
+	largest = np.maximum(fr, fg, out = _ScratchArray(scratch, "largest", (count,), fractions.dtype))
+	np.maximum(largest, fb, out = largest)
+	smallest = np.minimum(fr, fg, out = _ScratchArray(scratch, "smallest", (count,), fractions.dtype))
+	np.minimum(smallest, fb, out = smallest)
+	middle = np.add(fr, fg, out = _ScratchArray(scratch, "middle", (count,), fractions.dtype))
+	middle += fb
+	middle -= largest
+	middle -= smallest
+
+	whiteCorner = redStep + greenStep + blueStep
+	cornerCells = _ScratchArray(scratch, "cornerCells", (count,), np.intp)
+	corner = _ScratchArray(scratch, "corner", points.shape, lattice.dtype)
+	weight = _ScratchArray(scratch, "weight", (count, 1), fractions.dtype)
+	if out is None:
+		out = np.empty(points.shape, lattice.dtype)
+
+	np.take(flatLattice, cells, axis = 0, out = corner)
+	np.subtract(1.0, largest[:, np.newaxis], out = weight)
+	np.multiply(corner, weight, out = out, casting = 'same_kind')
+
+	np.add(cells, largestStep, out = cornerCells)
+	np.take(flatLattice, cornerCells, axis = 0, out = corner)
+	np.subtract(largest[:, np.newaxis], middle[:, np.newaxis], out = weight)
+	corner *= weight
+	np.add(out, corner, out = out, casting = 'same_kind')
+
+	np.subtract(cells, smallestStep, out = cornerCells)
+	cornerCells += whiteCorner
+	np.take(flatLattice, cornerCells, axis = 0, out = corner)
+	np.subtract(middle[:, np.newaxis], smallest[:, np.newaxis], out = weight)
+	corner *= weight
+	np.add(out, corner, out = out, casting = 'same_kind')
+
+	np.add(cells, whiteCorner, out = cornerCells)
+	np.take(flatLattice, cornerCells, axis = 0, out = corner)
+	corner *= smallest[:, np.newaxis]
+	np.add(out, corner, out = out, casting = 'same_kind')
+	return out
+
+def NearestInterpolation(lattice, points, out = None, scratch = None):
+	"""
+	Picks the closest lattice point for an (N, 3) array of float lattice coordinates (0 to cubeSize-1).
+	Returns an (N, 3) array, written into out if it is given. scratch is an optional dictionary of reusable work arrays.
+	"""
+	cubeSize = lattice.shape[0]
+	rounded = np.rint(points, out = _ScratchArray(scratch, "fractions", points.shape, points.dtype))
+	nearest = _ScratchArray(scratch, "lower", points.shape, np.intp)
+	np.copyto(nearest, rounded, casting = 'unsafe')
+	np.clip(nearest, 0, cubeSize - 1, out = nearest)
+	cells = _ScratchArray(scratch, "cells", points.shape[:1], np.intp)
+	np.multiply(nearest[:, 0], cubeSize, out = cells)
+	cells += nearest[:, 1]
+	cells *= cubeSize
+	cells += nearest[:, 2]
+	return np.take(lattice.reshape(-1, 3), cells, axis = 0, out = out)
+
+_INTERPOLATORS = {
+	INTERPOLATION_TRILINEAR: TrilinearInterpolation,
+	INTERPOLATION_TETRAHEDRAL: TetrahedralInterpolation,
+	INTERPOLATION_NEAREST: NearestInterpolation,
+}
+
+def InterpolateLattice(lattice, points, interpolation = INTERPOLATION_TRILINEAR, out = None, scratch = None):
+	"""
+	Interpolates an (N, 3) array of float lattice coordinates (0 to cubeSize-1) against a lattice using the named interpolation mode.
+	"""
+	if interpolation not in _INTERPOLATORS:
+		raise NameError("Unknown interpolation: " + str(interpolation) + ". Use one of " + ", ".join(sorted(_INTERPOLATORS)))
+	return _INTERPOLATORS[interpolation](lattice, points, out, scratch)
+
+def _LatticeHash(lattice):
+	"""
+	SHA-1 of the little-endian bytes of a lattice, as stored in pylut binary files.
+	"""
+	lattice = np.ascontiguousarray(lattice, dtype = lattice.dtype.newbyteorder('<'))
+	return hashlib.sha1(lattice.tobytes()).hexdigest()
+
+_lutCache = None
+
+def _CachedReader(reader):
+	"""
+	Wraps a LUT.From*File reader so that it goes through the LUTCache enabled with EnableLUTCache, if any.
+	"""
+	@functools.wraps(reader)
+	def CachedReader(lutFilePath, *args, **kwargs):
+		if _lutCache is None:
+			return reader(lutFilePath, *args, **kwargs)
+		return _lutCache.Load(reader, lutFilePath, *args, **kwargs)
+	return CachedReader
+
+def _IntegerTypeForBitdepth(bitdepth):
+	return np.uint8 if bitdepth <= 8 else np.uint16
+
+def _IntegerTableBytes(bitdepth, outputBitdepth):
+	return 2**(3 * bitdepth) * 3 * np.dtype(_IntegerTypeForBitdepth(outputBitdepth)).itemsize
+
+def _QuantizeValues(values, maxOutput):
+	"""
+	Used internally to turn 0-1 output values into integer codes from 0 to maxOutput, in place.
+	"""
+	np.clip(values, 0.0, 1.0, out = values)
+	values *= maxOutput
+	np.rint(values, out = values)
+	return values
+
+def _MakeDirectory(directory):
+	"""
+	Used internally to create a directory unless it exists. Safe when other processes create it at the same time.
+	"""
+	if not os.path.isdir(directory):
+		try:
+			os.makedirs(directory)
+		except OSError:
+			if not os.path.isdir(directory):
+				raise
+
+def _RequantizeCodes(codes, bitdepth, tableBitdepth):
+	"""
+	Used internally to map integer codes of bitdepth onto the nearest codes of tableBitdepth.
+	"""
+	if bitdepth == tableBitdepth:
+		return codes.astype(np.intp)
+	maxCode = 2**bitdepth - 1
+	return (codes.astype(np.intp) * (2 * (2**tableBitdepth - 1)) + maxCode) // (2 * maxCode)
+
+_LATTICE_OPERATIONS = {
+	"add": np.add,
+	"subtract": np.subtract,
+	"multiply": np.multiply,
+	"clip": np.clip,
+}
+
+class _LazyLattice:
+	"""
+	Deferred element-wise expression over lattices, built by the arithmetic methods of lazy LUTs.
+	A leaf holds a lattice, any other node applies one of _LATTICE_OPERATIONS to its operands, which are nodes, colors or scalars.
+	Evaluate computes the whole expression in one pass over blocks of lattice points, so a chain of operations never allocates an intermediate lattice.
+	"""
+	blockSize = 16384
+
+	def __init__(self, operation, operands):
+		self.operation = operation
+		self.operands = operands
+		if operation is None:
+			self.shape = operands[0].shape
+			self.dtype = operands[0].dtype
+		else:
+			self.shape = operands[0].shape
+			self.dtype = np.result_type(*[operand.dtype if isinstance(operand, _LazyLattice) else operand for operand in operands])
+
+	@staticmethod
+	def Leaf(lattice):
+		return _LazyLattice(None, [lattice])
+
+	def Evaluate(self):
+		lattice = np.empty(self.shape, self.dtype)
+		points = lattice.reshape(-1, 3)
+		for start in xrange(0, points.shape[0], self.blockSize):
+			self._EvaluateBlock(start, min(start + self.blockSize, points.shape[0]), points[start:start + self.blockSize])
+		return lattice
+
+	def _EvaluateBlock(self, start, end, out):
+		if self.operation is None:
+			out[...] = self.operands[0].reshape(-1, 3)[start:end]
+			return out
+		self.operands[0]._EvaluateBlock(start, end, out)
+		operands = []
+		for operand in self.operands[1:]:
+			if isinstance(operand, _LazyLattice):
+				operand = operand._EvaluateBlock(start, end, np.empty(out.shape, operand.dtype))
+			operands.append(operand)
+		_LATTICE_OPERATIONS[self.operation](out, *operands, out = out)
+		return out
+
+def _IsNumpyFile(path):
+	return os.path.splitext(path)[1].lower() == ".npy"
+
+def _FrameScale(dtype):
+	"""
+	Returns the code value that maps to 1.0 for integer frames, or None for floating point frames.
+	"""
+	if np.issubdtype(dtype, np.integer):
+		return float(np.iinfo(dtype).max)
+	return None
+
+def _OpenFrame(path, dtype):
+	"""
+	Memory-maps a frame read-only. .npy files carry their own shape and dtype, anything else is read as raw interleaved RGB of the given dtype.
+	"""
+	if _IsNumpyFile(path):
+		frame = np.load(path, mmap_mode = 'r')
+		if frame.shape[-1] != 3 or not frame.flags.c_contiguous:
+			raise NameError(path + " is not a C-ordered array with 3 channels in its last axis.")
+	else:
+		# np.memmap refuses empty files and sizes that are not a multiple of the dtype, so check before mapping
+		fileSize = os.path.getsize(path)
+		if fileSize == 0:
+			raise NameError(path + " is empty.")
+		if fileSize % (3 * np.dtype(dtype).itemsize) != 0:
+			raise NameError(path + " does not hold a whole number of " + np.dtype(dtype).name + " RGB pixels.")
+		frame = np.memmap(path, dtype = dtype, mode = 'r')
+	return frame
+
+def _CreateFrame(path, shape, dtype):
+	"""
+	Creates a writable memory-mapped frame, as .npy or raw interleaved RGB depending on the extension of path.
+	"""
+	if _IsNumpyFile(path):
+		return np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+	return np.memmap(path, dtype = dtype, mode = 'w+', shape = shape)
+
+def _PutUnlessStopped(queue, item, stopped):
+	while not stopped.is_set():
+		try:
+			queue.put(item, timeout = 0.1)
+			return True
+		except Queue.Full:
+			pass
+	return False
+
+def _GetUnlessStopped(queue, stopped):
+	while not stopped.is_set():
+		try:
+			return queue.get(timeout = 0.1)
+		except Queue.Empty:
+			pass
+	return None
+
+def _ReadFrameChunks(framePaths, dtype, chunkSize, workDtype, chunks, stopped):
+	"""
+	Reader stage of LUT.ApplyToFrameSequence. Queues each frame as chunks of up to chunkSize normalized pixels, then None.
+	An exception is queued in place of the remaining chunks if a frame cannot be read.
+	"""
+	try:
+		for inPath, outPath in framePaths:
+			frame = _OpenFrame(inPath, dtype)
+			scale = _FrameScale(frame.dtype)
+			pixels = frame.reshape(-1, 3)
+			for start in xrange(0, pixels.shape[0], chunkSize):
+				chunk = np.array(pixels[start:start + chunkSize], dtype = workDtype)
+				if scale is not None:
+					chunk /= scale
+				if not _PutUnlessStopped(chunks, (outPath, frame.shape, frame.dtype, start, chunk), stopped):
+					return
+			del frame, pixels
+		_PutUnlessStopped(chunks, None, stopped)
+	except Exception as e:
+		_PutUnlessStopped(chunks, e, stopped)
+
+def _WriteFrameChunks(results, stopped, errors):
+	"""
+	Writer stage of LUT.ApplyToFrameSequence. Stores processed chunks into memory-mapped output frames until it receives None.
+	"""
+	outPath = None
+	frame = None
+	try:
+		while True:
+			item = _GetUnlessStopped(results, stopped)
+			if item is None:
+				break
+			path, shape, dtype, start, chunk = item
+			if path != outPath:
+				if frame is not None:
+					frame.flush()
+				outPath = path
+				frame = _CreateFrame(path, shape, dtype)
+				pixels = frame.reshape(-1, 3)
+				scale = _FrameScale(dtype)
+			if scale is not None:
+				np.clip(chunk, 0.0, 1.0, out = chunk)
+				chunk *= scale
+				np.rint(chunk, out = chunk)
+			pixels[start:start + chunk.shape[0]] = chunk
+		if frame is not None:
+			frame.flush()
+	except Exception as e:
+		errors.append(e)
+		stopped.set()
+
 
 class Color:
 	"""
@@ -104,9 +709,9 @@ class Color:
 	@staticmethod
 	def FromFloatArray(array):
 		"""
-		Creates Color from a list or tuple of 3 floats.
+		Creates Color from a list, tuple or numpy array of 3 floats.
 		"""
-		return Color(array[0], array[1], array[2])
+		return Color(float(array[0]), float(array[1]), float(array[2]))
 
 	@staticmethod
 	def FromRGBIntegerArray(array, bitdepth):
@@ -177,15 +782,29 @@ class Color:
 
 class LUT:
 	"""
-	A class that represents a 3D LUT with a 3D numpy array. The idea is that the modifications are non-volatile, meaning that every modification method returns a new LUT object.
+	A class that represents a 3D LUT with a (cubeSize, cubeSize, cubeSize, 3) numpy array. The idea is that the modifications are non-volatile, meaning that every modification method returns a new LUT object.
 	"""
-	def __init__(self, lattice, name = "Untitled LUT"):
-		self.lattice = lattice
+	def __init__(self, lattice, name = "Untitled LUT", dtype = None, shaper = None, domainMin = 0.0, domainMax = 1.0, lazy = False):
+		if not isinstance(lattice, _LazyLattice):
+			lattice = np.asarray(lattice)
+			if lattice.dtype == object:
+				lattice = LatticeFromColorLattice(lattice, dtype or np.float64)
+			elif dtype is not None:
+				lattice = lattice.astype(dtype, copy = False)
+			elif lattice.dtype.kind != 'f':
+				lattice = lattice.astype(np.float64)
+
+		shape = lattice.shape
+		if len(shape) != 4 or shape[3] != 3 or not (shape[0] == shape[1] == shape[2]):
+			raise NameError("Invalid lattice shape: " + str(shape))
+
+		self._lattice = lattice
+		self.lazy = lazy
 		"""
-		Numpy 3D array representing the 3D LUT.
+		Whether the arithmetic methods of this LUT defer their work into an expression that is evaluated in one pass when the lattice is first read. See Lazy.
 		"""
 
-		self.cubeSize = self.lattice.shape[0]
+		self.cubeSize = shape[0]
 		"""
 		LUT is of size (cubeSize, cubeSize, cubeSize) and index positions are from 0 to cubeSize-1
 		"""
@@ -194,122 +813,318 @@ class LUT:
 		"""
 		Every LUT has a name!
 		"""
+
+		self.domainMin = np.array(domainMin, np.float64) * np.ones(3)
+		self.domainMax = np.array(domainMax, np.float64) * np.ones(3)
+		"""
+		Input values from domainMin to domainMax per channel are mapped onto the LUT. By default 0 to 1.
+		"""
+		if (self.domainMax <= self.domainMin).any():
+			raise NameError("Invalid LUT domain: " + str(self.domainMin) + " to " + str(self.domainMax))
+
+		if shaper is not None:
+			shaper = np.asarray(shaper, self.dtype)
+			if shaper.ndim != 2 or shaper.shape[1] != 3 or shaper.shape[0] < 2:
+				raise NameError("Invalid shaper shape: " + str(shaper.shape))
+		self.shaper = shaper
+		"""
+		Optional (size, 3) numpy array with a 1D LUT per channel that is applied to the domain-normalized input before the 3D lookup. Its values are 0-1 positions on the cube.
+		"""
+
+		self._integerTables = {}
+
+	def HasInputStage(self):
+		"""
+		Whether the LUT has a shaper or a domain other than 0 to 1.
+		"""
+		return self.shaper is not None or (self.domainMin != 0).any() or (self.domainMax != 1).any()
+
+	def _InputStage(self):
+		"""
+		Used internally to carry the shaper and domain over to a LUT derived from this one.
+		"""
+		return {"shaper": self.shaper, "domainMin": self.domainMin, "domainMax": self.domainMax}
+
+	def _SameInputStage(self, other):
+		if (self.domainMin != other.domainMin).any() or (self.domainMax != other.domainMax).any():
+			return False
+		if self.shaper is None or other.shaper is None:
+			return self.shaper is None and other.shaper is None
+		return self.shaper.shape == other.shaper.shape and (self.shaper == other.shaper).all()
+
+	def _ToLatticeCoordinates(self, colors, out):
+		"""
+		Used internally to map an (N, 3) array of input colors through the domain and shaper to lattice coordinates (0 to cubeSize-1), written into out.
+		"""
+		if self.domainMin.any() or (self.domainMax != 1).any():
+			np.subtract(colors, self.domainMin.astype(out.dtype), out = out)
+			out *= (1.0 / (self.domainMax - self.domainMin)).astype(out.dtype)
+			np.clip(out, 0.0, 1.0, out = out)
+		else:
+			np.clip(colors, 0.0, 1.0, out = out)
+		if self.shaper is not None:
+			shaperInputs = np.linspace(0.0, 1.0, self.shaper.shape[0])
+			for channel in xrange(3):
+				out[:, channel] = np.interp(out[:, channel], shaperInputs, self.shaper[:, channel])
+			np.clip(out, 0.0, 1.0, out = out)
+		out *= (self.cubeSize - 1)
+		return out
+
+	def WithoutInputStage(self, cubeSize = None, interpolation = INTERPOLATION_TRILINEAR):
+		"""
+		Returns a plain 0-1 LUT of size cubeSize (by default the size of this LUT) with the shaper and domain baked into the lattice, for formats that cannot store them.
+		"""
+		if cubeSize is None:
+			cubeSize = self.cubeSize
+		if not self.HasInputStage():
+			return self.Resize(cubeSize, interpolation = interpolation)
+		colors = IdentityLattice(cubeSize, self.dtype).reshape(-1, 3)
+		lattice = self.ApplyToArray(colors, interpolation = interpolation).reshape(cubeSize, cubeSize, cubeSize, 3)
+		return LUT(lattice, name = self.name)
+
+	def _SampledOverDomain(self):
+		"""
+		Used internally to reverse a LUT with an input stage: returns a plain LUT of the same size whose 0-1 inputs stand for inputs from domainMin to domainMax of this one.
+		"""
+		cubeSize = self.cubeSize
+		colors = self.domainMin + IdentityLattice(cubeSize).reshape(-1, 3) * (self.domainMax - self.domainMin)
+		lattice = self.ApplyToArray(colors).reshape(cubeSize, cubeSize, cubeSize, 3)
+		return LUT(lattice, name = self.name)
+
+	def _ReversedIntoDomain(self, reversedLUT):
+		"""
+		Used internally to map the 0-1 outputs of the reverse of _SampledOverDomain back into the domain of this LUT.
+		"""
+		lattice = self.domainMin + reversedLUT.lattice * (self.domainMax - self.domainMin)
+		return LUT(lattice.astype(self.dtype), name = reversedLUT.name)
+
+	@property
+	def lattice(self):
+		"""
+		Numpy (cubeSize, cubeSize, cubeSize, 3) float array representing the 3D LUT. Indexed as lattice[red, green, blue].
+		"""
+		if isinstance(self._lattice, _LazyLattice):
+			self._lattice = self._lattice.Evaluate()
+		return self._lattice
+
+	@property
+	def dtype(self):
+		"""
+		Numpy float type the lattice is stored as.
+		"""
+		return self._lattice.dtype
+
+	def Lazy(self, lazy = True):
+		"""
+		Returns this LUT with lazy arithmetic switched on or off.
+		The arithmetic methods and operators of a lazy LUT (AddColorToEachPoint, SubtractColorFromEachPoint, MultiplyEachPoint, ClampColor, +, - and *) return lazy LUTs that only record the operation.
+		The recorded chain is fused and evaluated in one pass over the lattice when the lattice is first read or written, instead of allocating a lattice per step.
+		"""
+		if lazy == self.lazy:
+			return self
+		return LUT(self._lattice, name = self.name, lazy = lazy, **self._InputStage())
+
+	def _LatticeNode(self):
+		if isinstance(self._lattice, _LazyLattice):
+			return self._lattice
+		return _LazyLattice.Leaf(self._lattice)
+
+	def _Elementwise(self, operation, *operands):
+		"""
+		Used internally by the arithmetic methods to apply one of _LATTICE_OPERATIONS to the lattice and operands (LUTs, colors or scalars), right away or, if a LUT involved is lazy, deferred.
+		"""
+		luts = [operand for operand in operands if isinstance(operand, LUT)]
+		if self.lazy or any(lut.lazy for lut in luts):
+			nodes = [operand._LatticeNode() if isinstance(operand, LUT) else operand for operand in operands]
+			return LUT(_LazyLattice(operation, [self._LatticeNode()] + nodes), lazy = True, **self._InputStage())
+		values = [operand.lattice if isinstance(operand, LUT) else operand for operand in operands]
+		return LUT(_LATTICE_OPERATIONS[operation](self.lattice, *values), **self._InputStage())
+
+	def AsType(self, dtype):
+		"""
+		Returns a LUT with the lattice stored as the given numpy float type.
+		"""
+		if np.dtype(dtype) == self.dtype:
+			return self
+		return LUT(self.lattice.astype(dtype), name = self.name, **self._InputStage())
 		
-	def Resize(self, newCubeSize, forceResize = False):
+	def Resize(self, newCubeSize, forceResize = False, interpolation = INTERPOLATION_TRILINEAR):
 		"""
 		Scales the lattice to a new cube size.
 		"""
 		if not forceResize and newCubeSize == self.cubeSize:
 			return self
 
-		newLattice = EmptyLatticeOfSize(newCubeSize)
-		ratio = float(self.cubeSize - 1.0) / float(newCubeSize-1.0)
-		for x in xrange(newCubeSize):
-			for y in xrange(newCubeSize):
-				for z in xrange(newCubeSize):
-					newLattice[x, y, z] = self.ColorAtInterpolatedLatticePoint(x*ratio, y*ratio, z*ratio)
-		return LUT(newLattice, name = self.name + "_Resized"+str(newCubeSize))
+		newLattice = self._SampleLattice(newCubeSize, interpolation)
+		return LUT(newLattice, name = self.name + "_Resized"+str(newCubeSize), **self._InputStage())
 
-	def _ResizeAndAddToData(self, newCubeSize, data, progress = False):
+	def _SampleLattice(self, cubeSize, interpolation = INTERPOLATION_TRILINEAR):
 		"""
-		Scales the lattice to a new cube size.
+		Used internally to interpolate the LUT at every point of an evenly spaced lattice of cubeSize in one batch.
+		"""
+		points = IdentityLattice(cubeSize, self.dtype).reshape(-1, 3) * self.dtype.type(self.cubeSize - 1)
+		return InterpolateLattice(self.lattice, points, interpolation).reshape(cubeSize, cubeSize, cubeSize, 3)
+
+	def Reverse(self, progress = False, neighbors = 1, workers = 1):
 		"""
-		newLattice = EmptyLatticeOfSize(newCubeSize)
-		ratio = float(self.cubeSize - 1.0) / float(newCubeSize-1.0)
-		maxVal = newCubeSize-1
+		Reverses a LUT. Warning: This can take a long time depending on if the input/output is a bijection.
+		With neighbors above 1 the inputs of that many nearest samples are blended by inverse distance instead of snapping to the nearest one.
+		With workers above 1 the red slabs of the reversed lattice are searched by a pool of that many processes sharing one search tree. None uses one process per CPU.
+		A LUT with a shaper or domain is sampled over its whole domain first, and the reversed LUT outputs colors in that domain.
+		"""
+		if self.HasInputStage():
+			return self._ReversedIntoDomain(self._SampledOverDomain().Reverse(progress, neighbors, workers))
+		tree = self.KDTree(progress)
+		sampleSize = self.cubeSize * 3
+		cubeSize = self.cubeSize
+		maxVal = cubeSize - 1
+		newLattice = EmptyLatticeOfSize(cubeSize, self.dtype)
+		if workers is None:
+			workers = multiprocessing.cpu_count()
 
-		bar = Bar("Building search tree", max = maxVal, suffix='%(percent)d%% - %(eta)ds remain')
+		bar = Bar("Searching for matches", max = maxVal, suffix='%(percent)d%% - %(eta)ds remain')
+		pool = None
 		try:
-			for x in xrange(newCubeSize):
+			if workers > 1:
+				pool = multiprocessing.Pool(workers, _InitReverseWorker, (tree, cubeSize, sampleSize, neighbors))
+				slabs = pool.imap_unordered(_ReverseWorkerSlab, xrange(cubeSize))
+			else:
+				slabs = (_ReverseSlab(tree, x, cubeSize, sampleSize, neighbors) for x in xrange(cubeSize))
+			for x, slab in slabs:
 				if progress:
 					bar.next()
-				for y in xrange(newCubeSize):
-					for z in xrange(newCubeSize):
-						data.add(self.ColorAtInterpolatedLatticePoint(x*ratio, y*ratio, z*ratio).ToFloatArray(), (RemapIntTo01(x,maxVal), RemapIntTo01(y,maxVal), RemapIntTo01(z,maxVal)))
+				newLattice[x] = slab
+			if pool is not None:
+				pool.close()
+				pool.join()
 		except KeyboardInterrupt:
+			if pool is not None:
+				pool.terminate()
 			bar.finish()
 			raise KeyboardInterrupt
 		bar.finish()
-		return data
-
-	def Reverse(self, progress = False):
+		return LUT(newLattice, name = self.name +"_Reverse")
+	
+	def ReverseIterative(self, tolerance = 1e-6, maxIterations = 20, interpolation = INTERPOLATION_TRILINEAR, seedCubeSize = 17, progress = False):
 		"""
-		Reverses a LUT. Warning: This can take a long time depending on if the input/output is a bijection.
+		Reverses a LUT by solving, for every point of the reversed lattice, for the input color that the LUT maps to it.
+		Each point is seeded with the nearest sample of the LUT resized to seedCubeSize and refined with damped Newton steps against the interpolated LUT until every channel is within tolerance.
+		Colors outside of what the LUT can produce converge to the closest input on the edge of the cube.
+		A LUT with a shaper or domain is sampled over its whole domain first, and the reversed LUT outputs colors in that domain.
 		"""
-		tree = self.KDTree(progress)
-		newLattice = EmptyLatticeOfSize(self.cubeSize)
-		maxVal = self.cubeSize - 1
-		bar = Bar("Searching for matches", max = maxVal, suffix='%(percent)d%% - %(eta)ds remain')
+		if self.HasInputStage():
+			return self._ReversedIntoDomain(self._SampledOverDomain().ReverseIterative(tolerance, maxIterations, interpolation, seedCubeSize, progress))
+		cubeSize = self.cubeSize
+		maxVal = cubeSize - 1
+		targets = IdentityLattice(cubeSize).reshape(-1, 3)
+		lattice = self.lattice.astype(np.float64, copy = False)
+
+		def Forward(inputs):
+			return InterpolateLattice(lattice, inputs * maxVal, interpolation)
+
+		solution = self._ReverseSeeds(targets, min(seedCubeSize, cubeSize))
+		residual = Forward(solution) - targets
+		error = np.abs(residual).max(axis = 1)
+
+		bar = Bar("Refining inverse", max = maxIterations, suffix='%(percent)d%% - %(eta)ds remain')
 		try:
-			for x in xrange(self.cubeSize):
+			for iteration in xrange(maxIterations):
 				if progress:
 					bar.next()
-				for y in xrange(self.cubeSize):
-					for z in xrange(self.cubeSize):
-						newLattice[x, y, z] = Color.FromFloatArray(tree.search_nn((RemapIntTo01(x,maxVal), RemapIntTo01(y,maxVal), RemapIntTo01(z,maxVal))).aux)
+				active = np.nonzero(error > tolerance)[0]
+				if len(active) == 0:
+					break
+
+				inputs = solution[active]
+				step = _SolveLinear3x3(_ForwardJacobian(Forward, inputs), residual[active])
+
+				# halve steps that do not reduce the error
+				for halving in xrange(4):
+					candidates = np.clip(inputs - step, 0.0, 1.0)
+					candidateResidual = Forward(candidates) - targets[active]
+					candidateError = np.abs(candidateResidual).max(axis = 1)
+					improved = candidateError < error[active]
+					accepted = active[improved]
+					solution[accepted] = candidates[improved]
+					residual[accepted] = candidateResidual[improved]
+					error[accepted] = candidateError[improved]
+					if improved.all():
+						break
+					active, inputs, step = active[~improved], inputs[~improved], step[~improved] * 0.5
 		except KeyboardInterrupt:
 			bar.finish()
 			raise KeyboardInterrupt
 		bar.finish()
+
+		newLattice = solution.reshape(cubeSize, cubeSize, cubeSize, 3).astype(self.dtype)
 		return LUT(newLattice, name = self.name +"_Reverse")
-	
+
+	def _ReverseSeeds(self, targets, seedCubeSize):
+		"""
+		Used internally to find, for every target color, the input of the nearest output of the LUT resized to seedCubeSize.
+		"""
+		tree = kdtree.FlatKDTree(self._SampleLattice(seedCubeSize).reshape(-1, 3))
+		distances, nodes = tree.search_nn_batch(targets)
+		return IdentityLattice(seedCubeSize).reshape(-1, 3)[tree.indices[nodes]].astype(np.float64)
+
 	def KDTree(self, progress = False):
-		tree = kdtree.create(dimensions=3)
-		
-		tree = self._ResizeAndAddToData(self.cubeSize*3, tree, progress)
-	
+		"""
+		Builds a flat kd-tree of the output colors of the LUT sampled at 3 times its cube size. The indices of the tree refer to the sample grid, blue changing fastest.
+		"""
+		sampleSize = self.cubeSize * 3
+		bar = Bar("Building search tree", max = 1, suffix='%(percent)d%% - %(eta)ds remain')
+		try:
+			outputs = self._SampleLattice(sampleSize).reshape(-1, 3)
+			tree = kdtree.FlatKDTree(outputs)
+			if progress:
+				bar.next()
+		except KeyboardInterrupt:
+			bar.finish()
+			raise KeyboardInterrupt
+		bar.finish()
 		return tree
 
 		
-	def CombineWithLUT(self, otherLUT):
+	def CombineWithLUT(self, otherLUT, cubeSize = None, interpolation = INTERPOLATION_TRILINEAR):
 		"""
-		Combines LUT with another LUT.
+		Combines LUT with another LUT by piping this LUT's output through otherLUT. The LUTs may be of different sizes.
+		The combined LUT is of size cubeSize, which defaults to the size of this LUT. interpolation is used both when resampling this LUT and when looking up otherLUT.
 		"""
-		if self.cubeSize is not otherLUT.cubeSize:
-			raise NameError("Lattice Sizes not equivalent")
-		
-		
-		cubeSize = self.cubeSize
-		newLattice = EmptyLatticeOfSize(cubeSize)
-		
-		for x in xrange(cubeSize):
-			for y in xrange(cubeSize):
-				for z in xrange(cubeSize):
-					selfColor = self.lattice[x, y, z].Clamped01()
-					newLattice[x, y, z] = otherLUT.ColorFromColor(selfColor)
-		return LUT(newLattice, name = self.name + "+" + otherLUT.name)
+		if cubeSize is None:
+			cubeSize = self.cubeSize
+
+		if cubeSize == self.cubeSize:
+			selfLattice = self.lattice
+		else:
+			selfLattice = self._SampleLattice(cubeSize, interpolation)
+
+		newLattice = otherLUT.ApplyToArray(selfLattice, interpolation = interpolation)
+		return LUT(newLattice, name = self.name + "+" + otherLUT.name, **self._InputStage())
 
 	def ClampColor(self, min, max):
 		"""
 		Returns a new RGB clamped LUT.
 		"""
-		cubeSize = self.cubeSize
-		newLattice = EmptyLatticeOfSize(cubeSize)
-		for x in xrange(cubeSize):
-			for y in xrange(cubeSize):
-				for z in xrange(cubeSize):
-					newLattice[x, y, z] = self.ColorAtLatticePoint(x, y, z).ClampColor(min, max)
-		return LUT(newLattice)
+		if min.r > max.r or min.g > max.g or min.b > max.b:
+			raise NameError("Invalid Clamp Values")
+		return self._Elementwise("clip", self._ColorAsArray(min), self._ColorAsArray(max))
 
-	def _LatticeTo3DLString(self, bitdepth):
+	def _Write3DLLattice(self, lutFile, bitdepth):
 		"""
-		Used for internal creating of 3DL files.
+		Used for internal creating of 3DL files. Writes the clamped lattice as integers at bitdepth, blue changing fastest.
 		"""
-		string = ""
-		cubeSize = self.cubeSize
-		for currentCubeIndex in range(0, cubeSize**3):
-			redIndex = currentCubeIndex / (cubeSize*cubeSize)
-			greenIndex = ( (currentCubeIndex % (cubeSize*cubeSize)) / (cubeSize) )
-			blueIndex = currentCubeIndex % cubeSize
-
-			latticePointColor = self.lattice[redIndex, greenIndex, blueIndex].Clamped01()
-			
-			string += latticePointColor.FormattedAsInteger(2**bitdepth-1) + "\n"
-		
-		return string
+		maxVal = 2**bitdepth - 1
+		rjustValue = len(str(maxVal)) + 1
+		points = np.clip(self.lattice.reshape(-1, 3), 0, 1).astype(np.float64)
+		# same rounding as Remap01ToInt
+		points = np.floor(points * float(maxVal) + 0.5).astype(np.int64)
+		_WriteFormattedRows(lutFile, points, " ".join(["%" + str(rjustValue) + "d"] * 3))
+		lutFile.write("\n")
 
 	
 	def ToLustre3DLFile(self, fileOutPath, bitdepth = 12):
+		if self.HasInputStage():
+			return self.WithoutInputStage().ToLustre3DLFile(fileOutPath, bitdepth)
 		cubeSize = self.cubeSize
 		inputDepth = math.log(cubeSize-1, 2)
 
@@ -322,100 +1137,325 @@ class LUT:
 		lutFile.write("Mesh " + str(int(inputDepth)) + " " + str(bitdepth) + "\n")
 		lutFile.write(' '.join([str(int(x)) for x in Indices(cubeSize, 2**10 - 1)]) + "\n")
 		
-		lutFile.write(self._LatticeTo3DLString(bitdepth))
+		self._Write3DLLattice(lutFile, bitdepth)
 
 		lutFile.write("\n#Tokens required by applications - do not edit\nLUT8\ngamma 1.0")
 
 		lutFile.close()
 
 	def ToNuke3DLFile(self, fileOutPath, bitdepth = 16):
+		if self.HasInputStage():
+			return self.WithoutInputStage().ToNuke3DLFile(fileOutPath, bitdepth)
 		cubeSize = self.cubeSize
 
 		lutFile = open(fileOutPath, 'w')
 
 		lutFile.write(' '.join([str(int(x)) for x in Indices(cubeSize, 2**bitdepth - 1)]) + "\n")
 
-		lutFile.write(self._LatticeTo3DLString(bitdepth))
+		self._Write3DLLattice(lutFile, bitdepth)
 
 		lutFile.close()
 	
 	def ToCubeFile(self, cubeFileOutPath):
 		cubeSize = self.cubeSize
 		cubeFile = open(cubeFileOutPath, 'w')
+		if self.domainMin.any() or (self.domainMax != 1).any():
+			cubeFile.write("DOMAIN_MIN %1.6f %1.6f %1.6f\n" % tuple(self.domainMin))
+			cubeFile.write("DOMAIN_MAX %1.6f %1.6f %1.6f\n" % tuple(self.domainMax))
+		if self.shaper is not None:
+			cubeFile.write("LUT_1D_SIZE " + str(self.shaper.shape[0]) + "\n")
 		cubeFile.write("LUT_3D_SIZE " + str(cubeSize) + "\n")
-		
-		for currentCubeIndex in range(0, cubeSize**3):
-			redIndex = currentCubeIndex % cubeSize
-			greenIndex = ( (currentCubeIndex % (cubeSize*cubeSize)) / (cubeSize) )
-			blueIndex = currentCubeIndex / (cubeSize*cubeSize)
-
-			latticePointColor = self.lattice[redIndex, greenIndex, blueIndex].Clamped01()
-			
-			cubeFile.write( latticePointColor.FormattedAsFloat() )
-			
-			if(currentCubeIndex != cubeSize**3 - 1):
-				cubeFile.write("\n")
+
+		# the shaper comes before the cube
+		if self.shaper is not None:
+			_WriteFormattedRows(cubeFile, np.clip(self.shaper, 0, 1), "%1.6f %1.6f %1.6f")
+			cubeFile.write("\n")
+		# .cube files are ordered with red changing fastest
+		points = np.clip(self.lattice.transpose(2, 1, 0, 3).reshape(-1, 3), 0, 1)
+		_WriteFormattedRows(cubeFile, points, "%1.6f %1.6f %1.6f")
 
 		cubeFile.close()
 
 	def ToFSIDatFile(self, datFileOutPath):
-		import tempfile
 		cubeSize = 64
-		datFile = open(datFileOutPath, 'w+b')
-		if self.cubeSize is not 64:
-			lut = self.Resize(64)
-		else:
-			lut = self
-		lut_checksum = 0
-		lut_bytes = []
-		for currentCubeIndex in range(0, cubeSize**3):
-			redIndex = currentCubeIndex % cubeSize
-			greenIndex = ( (currentCubeIndex % (cubeSize*cubeSize)) / (cubeSize) )
-			blueIndex = currentCubeIndex / (cubeSize*cubeSize)
-
-			latticePointColor = lut.lattice[redIndex, greenIndex, blueIndex].Clamped01()
-			
-			rgb_packed =( Remap01ToInt(latticePointColor.r, 1008) | Remap01ToInt(latticePointColor.g, 1008) << 10 | Remap01ToInt(latticePointColor.g, 1008) << 20 )
-			rgb_packed_binary = struct.pack("<L", rgb_packed)
-			lut_checksum = (lut_checksum + rgb_packed) % 4294967296
-			lut_bytes.append(rgb_packed_binary)
-
-		header_bytes = []
-		header_bytes.append(struct.pack("<L",0x42340299))#magic number
-		header_bytes.append(struct.pack("<L",0x01000002))#spec version number?
-		header_bytes.append(bytearray("None".ljust(16)))#monitor ID (real ID not required if dit.dat file)
-		header_bytes.append(bytearray("V1.0".ljust(16)))#lut version number
-		header_bytes.append(struct.pack("<L", lut_checksum))
-		header_bytes.append(struct.pack("<L",1048576))#number of bytes in LUT (always the same)
-		header_bytes.append(bytearray("pylut generated".ljust(16)))#author
-		header_bytes.append(bytearray(" ".ljust(63)))#reserved
-
-		header_checksum = 0
-
-		for item in header_bytes:
-			if isinstance(item, str):
-				itemSum = sum(map(ord,item)) 
-			else:
-				itemSum = sum(item)
-			header_checksum = (header_checksum + itemSum) % 256
-
-		header_bytes.append(struct.pack("<B",header_checksum))
-
-
-		[datFile.write(x) for x in header_bytes]
-		[datFile.write(x) for x in lut_bytes]
+		lut = self.WithoutInputStage(cubeSize)
+
+		# .dat files are ordered with red changing fastest and hold 10 bit values scaled to 1008
+		points = np.clip(lut.lattice.transpose(2, 1, 0, 3).reshape(-1, 3), 0, 1).astype(np.float64)
+		# same rounding as Remap01ToInt
+		points = np.floor(points * 1008.0 + 0.5).astype(np.uint32)
+		rgb_packed = (points[:, 0] | points[:, 1] << 10 | points[:, 2] << 20).astype('<u4')
+		lut_checksum = int(rgb_packed.sum(dtype = np.uint64) % 4294967296)
+
+		header_bytes = struct.pack("<LL16s16sLL16s63s",
+			0x42340299,#magic number
+			0x01000002,#spec version number?
+			b"None".ljust(16),#monitor ID (real ID not required if dit.dat file)
+			b"V1.0".ljust(16),#lut version number
+			lut_checksum,
+			1048576,#number of bytes in LUT (always the same)
+			b"pylut generated".ljust(16),#author
+			b" ".ljust(63))#reserved
+		header_checksum = int(np.frombuffer(header_bytes, np.uint8).sum() % 256)
 
+		datFile = open(datFileOutPath, 'w+b')
+		datFile.write(header_bytes)
+		datFile.write(struct.pack("<B", header_checksum))
+		datFile.write(rgb_packed.tobytes())
 		datFile.close()
 
+	def ToBinaryFile(self, binaryFileOutPath):
+		"""
+		Writes the LUT to pylut's native binary format: a magic string, a version, a small JSON header (name, cube size, dtype, domain, shaper size and a SHA-1 of the lattice) and the raw little-endian lattice aligned to 64 bytes so it can be memory-mapped, followed by the shaper if there is one.
+		"""
+		lattice = np.ascontiguousarray(self.lattice, dtype = self.dtype.newbyteorder('<'))
+		header = json.dumps({
+			"name": self.name,
+			"cubeSize": self.cubeSize,
+			"dtype": lattice.dtype.str,
+			"domainMin": [float(x) for x in self.domainMin],
+			"domainMax": [float(x) for x in self.domainMax],
+			"shaperSize": 0 if self.shaper is None else self.shaper.shape[0],
+			"hash": _LatticeHash(lattice),
+		}, sort_keys = True)
+		padding = -(len(BINARY_MAGIC) + _BINARY_PREFIX.size + len(header) + 1) % _BINARY_ALIGNMENT
+		header = (header + " " * padding + "\n").encode('ascii')
+
+		binaryFile = open(binaryFileOutPath, 'wb')
+		binaryFile.write(BINARY_MAGIC)
+		binaryFile.write(_BINARY_PREFIX.pack(BINARY_VERSION, 0, len(header)))
+		binaryFile.write(header)
+		lattice.tofile(binaryFile)
+		if self.shaper is not None:
+			np.ascontiguousarray(self.shaper, dtype = lattice.dtype).tofile(binaryFile)
+		binaryFile.close()
+
+
+
+	def ApplyToArray(self, array, out = None, interpolation = INTERPOLATION_TRILINEAR, threads = 1, tileSize = None):
+		"""
+		Pipes an (H, W, 3) image or an (N, 3) array of floating point RGB values through the LUT in one vectorized pass.
+		interpolation is one of INTERPOLATION_TRILINEAR, INTERPOLATION_TETRAHEDRAL or INTERPOLATION_NEAREST.
+		Values are normalized by the domain, clamped to 0-1 and passed through the shaper like ColorFromColor. Pass a preallocated C-contiguous array of the same shape as out to avoid allocating a result.
+		The pixels are processed in tiles of tileSize pixels (default APPLY_TILE_SIZE), so the work arrays stay small whatever the size of the image. With threads above 1 the tiles are spread over a pool of that many threads. None uses one thread per CPU.
+		Each thread reuses its own work arrays from tile to tile.
+		"""
+		array = np.asarray(array)
+		if array.shape[-1] != 3:
+			raise NameError("Array must have 3 channels in its last axis.")
+
+		if out is None:
+			out = np.empty(array.shape, self.dtype)
+		elif out.shape != array.shape or not out.flags.c_contiguous:
+			raise NameError("Output array must be C-contiguous and the same shape as the input array.")
+
+		flatArray = array.reshape(-1, 3)
+		flatOut = out.reshape(-1, 3)
+		if threads is None:
+			threads = multiprocessing.cpu_count()
+
+		if tileSize is None:
+			tileSize = APPLY_TILE_SIZE
+		tileStarts = xrange(0, flatArray.shape[0], tileSize)
+
+		if threads <= 1:
+			scratch = {}
+			for start in tileStarts:
+				end = min(start + tileSize, flatArray.shape[0])
+				self._ApplyToTile(flatArray[start:end], flatOut[start:end], interpolation, scratch)
+			return out
+
+		threadState = threading.local()
+
+		def ApplyToTile(start):
+			if not hasattr(threadState, "scratch"):
+				threadState.scratch = {}
+			end = min(start + tileSize, flatArray.shape[0])
+			self._ApplyToTile(flatArray[start:end], flatOut[start:end], interpolation, threadState.scratch)
+
+		pool = ThreadPool(threads)
+		try:
+			pool.map(ApplyToTile, tileStarts)
+		finally:
+			pool.close()
+			pool.join()
+		return out
 
+	def _ApplyToTile(self, tile, outTile, interpolation, scratch):
+		"""
+		Used internally by ApplyToArray to pipe one (N, 3) tile through the LUT using the work arrays in scratch.
+		"""
+		points = self._ToLatticeCoordinates(tile, _ScratchArray(scratch, "points", tile.shape, self.dtype))
+		InterpolateLattice(self.lattice, points, interpolation, outTile, scratch)
 
-	def ColorFromColor(self, color):
+	def IntegerTable(self, bitdepth = 8, outputBitdepth = None, interpolation = INTERPOLATION_TRILINEAR, directory = None):
+		"""
+		Returns the LUT baked into a dense (2^bitdepth, 2^bitdepth, 2^bitdepth, 3) table of integer output codes at outputBitdepth (default bitdepth), indexed by the integer input codes [red, green, blue].
+		Outputs up to 8 bits are stored as uint8, deeper ones as uint16. Tables larger than MAX_INTEGER_TABLE_BYTES are refused.
+		Tables are cached on the LUT. With a directory they are also stored there as .npy files named after the LUT contents and reused, memory-mapped, by later calls.
+		"""
+		if outputBitdepth is None:
+			outputBitdepth = bitdepth
+		outputType = _IntegerTypeForBitdepth(outputBitdepth)
+		tableSize = 2**bitdepth
+		if _IntegerTableBytes(bitdepth, outputBitdepth) > MAX_INTEGER_TABLE_BYTES:
+			raise NameError("An integer table at " + str(bitdepth) + " bits would exceed MAX_INTEGER_TABLE_BYTES.")
+		key = (bitdepth, outputBitdepth, interpolation)
+		table = self._integerTables.get(key)
+
+		store = False
+		if directory is not None:
+			_MakeDirectory(directory)
+			tableHash = hashlib.sha1(_LatticeHash(self.lattice).encode('ascii'))
+			tableHash.update(repr((key, list(self.domainMin), list(self.domainMax))).encode('ascii'))
+			if self.shaper is not None:
+				tableHash.update(_LatticeHash(self.shaper).encode('ascii'))
+			tablePath = os.path.join(directory, tableHash.hexdigest() + ".npy")
+			if not os.path.isfile(tablePath):
+				store = True
+			elif table is None:
+				storedTable = np.load(tablePath, mmap_mode = 'r')
+				if storedTable.shape == (tableSize, tableSize, tableSize, 3) and storedTable.dtype == outputType:
+					table = storedTable
+				else:
+					store = True
+
+		if table is None:
+			table = self._BakeIntegerTable(bitdepth, outputBitdepth, interpolation)
+		if store:
+			fileDescriptor, temporaryPath = tempfile.mkstemp(suffix = ".tmp", dir = directory)
+			temporaryFile = os.fdopen(fileDescriptor, 'wb')
+			np.save(temporaryFile, table)
+			temporaryFile.close()
+			os.rename(temporaryPath, tablePath)
+		self._integerTables[key] = table
+		return table
+
+	def _BakeIntegerTable(self, bitdepth, outputBitdepth, interpolation):
+		"""
+		Used internally by IntegerTable to fill a new integer table by piping every input code through the LUT.
+		"""
+		tableSize = 2**bitdepth
+		table = np.empty((tableSize, tableSize, tableSize, 3), _IntegerTypeForBitdepth(outputBitdepth))
+		maxOutput = float(2**outputBitdepth - 1)
+		codes = np.arange(tableSize, dtype = self.dtype) / self.dtype.type(tableSize - 1)
+		slab = np.empty((tableSize * tableSize, 3), self.dtype)
+		slab[:, 1] = np.repeat(codes, tableSize)
+		slab[:, 2] = np.tile(codes, tableSize)
+		values = np.empty(slab.shape, self.dtype)
+		for red in xrange(tableSize):
+			slab[:, 0] = codes[red]
+			self.ApplyToArray(slab, out = values, interpolation = interpolation)
+			table[red] = _QuantizeValues(values, maxOutput).reshape(tableSize, tableSize, 3)
+		return table
+
+	def _ApplyToIntegerCodes(self, codes, bitdepth, outputBitdepth, interpolation, out):
+		"""
+		Used internally by ApplyToIntegerArray to pipe (N, 3) integer codes through the LUT with interpolation instead of a table, in chunks of FRAME_CHUNK_SIZE pixels. Gives the same codes as a table at bitdepth.
+		"""
+		maxCode = self.dtype.type(2**bitdepth - 1)
+		maxOutput = float(2**outputBitdepth - 1)
+		for start in xrange(0, len(codes), FRAME_CHUNK_SIZE):
+			values = np.divide(codes[start:start + FRAME_CHUNK_SIZE], maxCode, dtype = self.dtype)
+			self.ApplyToArray(values, out = values, interpolation = interpolation)
+			out[start:start + FRAME_CHUNK_SIZE] = _QuantizeValues(values, maxOutput)
+		return out
+
+	def ApplyToIntegerArray(self, array, bitdepth = 8, outputBitdepth = None, tableBitdepth = None, interpolation = INTERPOLATION_TRILINEAR, directory = None, out = None):
+		"""
+		Pipes an (H, W, 3) image or an (N, 3) array of integer RGB codes of bitdepth through the LUT with a single lookup in the table from IntegerTable, without any interpolation math.
+		The table is built at tableBitdepth, by default bitdepth. Codes deeper than MAX_DEFAULT_TABLE_BITDEPTH are interpolated exactly instead unless a tableBitdepth is given, as their tables take long to bake and a lot of memory.
+		Codes deeper than tableBitdepth are requantized to the nearest table code first, which costs precision but keeps the table small.
+		Returns integer codes at outputBitdepth (default bitdepth).
+		"""
+		array = np.asarray(array)
+		if array.shape[-1] != 3:
+			raise NameError("Array must have 3 channels in its last axis.")
+		if array.dtype.kind not in 'ui':
+			raise NameError("Array must hold integer codes.")
+		if outputBitdepth is None:
+			outputBitdepth = bitdepth
+		outputType = np.dtype(_IntegerTypeForBitdepth(outputBitdepth))
+
+		if out is None:
+			out = np.empty(array.shape, outputType)
+		elif out.shape != array.shape or out.dtype != outputType or not out.flags.c_contiguous:
+			raise NameError("Output array must be C-contiguous, of type " + outputType.name + " and the same shape as the input array.")
+
+		codes = np.clip(array.reshape(-1, 3), 0, 2**bitdepth - 1)
+		if tableBitdepth is None:
+			if bitdepth > MAX_DEFAULT_TABLE_BITDEPTH:
+				self._ApplyToIntegerCodes(codes, bitdepth, outputBitdepth, interpolation, out.reshape(-1, 3))
+				return out
+			tableBitdepth = bitdepth
+		table = self.IntegerTable(tableBitdepth, outputBitdepth, interpolation, directory)
+		codes = _RequantizeCodes(codes, bitdepth, tableBitdepth)
+		indices = codes[:, 0] << (2 * tableBitdepth)
+		indices |= codes[:, 1] << tableBitdepth
+		indices |= codes[:, 2]
+		np.take(table.reshape(-1, 3), indices, axis = 0, out = out.reshape(-1, 3))
+		return out
+
+	def ApplyToFrameSequence(self, framePaths, dtype = np.float32, interpolation = INTERPOLATION_TRILINEAR, chunkSize = FRAME_CHUNK_SIZE, queueSize = 4, progress = False):
+		"""
+		Pipes a sequence of frame files through the LUT. framePaths is a list of (inputPath, outputPath) pairs.
+		Frames are .npy files or raw interleaved RGB files of the given dtype (uint8, uint16 or float32). Integer frames are treated as 0 to the maximum code value.
+		Each output is written in the dtype and shape of its input, as .npy or raw depending on its extension.
+		Inputs and outputs are memory-mapped and processed in chunks of chunkSize pixels. Reading, applying and writing run on separate threads connected by queues of queueSize chunks, so only a few chunks are ever held in memory.
+		"""
+		framePaths = list(framePaths)
+		chunks = Queue.Queue(queueSize)
+		results = Queue.Queue(queueSize)
+		stopped = threading.Event()
+		errors = []
+		reader = threading.Thread(target = _ReadFrameChunks, args = (framePaths, dtype, chunkSize, self.dtype, chunks, stopped))
+		writer = threading.Thread(target = _WriteFrameChunks, args = (results, stopped, errors))
+		reader.daemon = True
+		writer.daemon = True
+		reader.start()
+		writer.start()
+
+		bar = Bar("Applying to frames", max = len(framePaths), suffix='%(percent)d%% - %(eta)ds remain')
+		try:
+			while True:
+				item = _GetUnlessStopped(chunks, stopped)
+				if item is None:
+					break
+				if isinstance(item, Exception):
+					errors.append(item)
+					break
+				outPath, shape, frameDtype, start, chunk = item
+				self.ApplyToArray(chunk, out = chunk, interpolation = interpolation)
+				if not _PutUnlessStopped(results, item, stopped):
+					break
+				if progress and start + chunk.shape[0] == np.prod(shape) // 3:
+					bar.next()
+			if not errors:
+				_PutUnlessStopped(results, None, stopped)
+				writer.join()
+		except:
+			stopped.set()
+			raise
+		finally:
+			if errors:
+				stopped.set()
+			reader.join()
+			writer.join()
+			bar.finish()
+		if errors:
+			raise errors[0]
+		return len(framePaths)
+
+	def ColorFromColor(self, color, interpolation = INTERPOLATION_TRILINEAR):
 		"""
 		Returns what a color value should be transformed to when piped through the LUT.
 		"""
+		if self.HasInputStage():
+			points = self._ToLatticeCoordinates(np.array([color.ToFloatArray()]), np.empty((1, 3)))
+			return self.ColorAtInterpolatedLatticePoint(points[0, 0], points[0, 1], points[0, 2], interpolation)
 		color = color.Clamped01()
 		cubeSize = self.cubeSize
-		return self.ColorAtInterpolatedLatticePoint(color.r * (cubeSize-1), color.g * (cubeSize-1), color.b * (cubeSize-1))
+		return self.ColorAtInterpolatedLatticePoint(color.r * (cubeSize-1), color.g * (cubeSize-1), color.b * (cubeSize-1), interpolation)
 
 	#integer input from 0 to cubeSize-1
 	def ColorAtLatticePoint(self, redPoint, greenPoint, bluePoint):
@@ -426,10 +1466,10 @@ class LUT:
 		if redPoint > cubeSize-1 or greenPoint > cubeSize-1 or bluePoint > cubeSize-1:
 			raise NameError("Point Out of Bounds: (" + str(redPoint) + ", " + str(greenPoint) + ", " + str(bluePoint) + ")")
 
-		return self.lattice[int(redPoint), int(greenPoint), int(bluePoint)]
+		return Color.FromFloatArray(self.lattice[int(redPoint), int(greenPoint), int(bluePoint)])
 
 	#float input from 0 to cubeSize-1
-	def ColorAtInterpolatedLatticePoint(self, redPoint, greenPoint, bluePoint):
+	def ColorAtInterpolatedLatticePoint(self, redPoint, greenPoint, bluePoint, interpolation = INTERPOLATION_TRILINEAR):
 		"""
 		Gets the interpolated color at an interpolated lattice point.
 		"""
@@ -438,6 +1478,10 @@ class LUT:
 		if 0 < redPoint > cubeSize-1 or 0 < greenPoint > cubeSize-1 or 0 < bluePoint > cubeSize-1:
 			raise NameError("Point Out of Bounds")
 
+		if interpolation != INTERPOLATION_TRILINEAR:
+			point = np.array([[redPoint, greenPoint, bluePoint]], self.dtype)
+			return Color.FromFloatArray(InterpolateLattice(self.lattice, point, interpolation)[0])
+
 		lowerRedPoint = Clamp(int(math.floor(redPoint)), 0, cubeSize-1)
 		upperRedPoint = Clamp(lowerRedPoint + 1, 0, cubeSize-1)
 
@@ -476,166 +1520,171 @@ class LUT:
 		return LerpColor(C0, C1, 1.0 - (upperGreenPoint - greenPoint))
 
 	@staticmethod
-	def FromIdentity(cubeSize):
+	def FromIdentity(cubeSize, dtype = np.float64):
 		"""
-		Creates an identity LUT of specified size.
+		Creates an identity LUT of specified size. Its lattice comes from IdentityLattice, so it is read-only and may be shared with other identity LUTs.
 		"""
-		identityLattice = EmptyLatticeOfSize(cubeSize)
-		indices01 = Indices01(cubeSize)
-		for r in xrange(cubeSize):
-			for g in xrange(cubeSize):
-				for b in xrange(cubeSize):
-					identityLattice[r, g, b] = Color(indices01[r], indices01[g], indices01[b])
-		return LUT(identityLattice, name = "Identity"+str(cubeSize))
+		return LUT(IdentityLattice(cubeSize, dtype), name = "Identity"+str(cubeSize))
 
 	@staticmethod
-	def FromLustre3DLFile(lutFilePath):
+	@_CachedReader
+	def FromLustre3DLFile(lutFilePath, dtype = np.float64):
 		lutFile = open(lutFilePath, 'rU')
-		lutFileLines = lutFile.readlines()
+		header, body = _SplitHeaderAndBody(lutFile.read())
 		lutFile.close()
 
-		meshLineIndex = 0
-		cubeSize = -1
-
-		for line in lutFileLines:
-			if "Mesh" in line:
-				inputDepth = int(line.split()[1])
-				outputDepth = int(line.split()[2])
-				cubeSize = 2**inputDepth + 1
-				break
-			meshLineIndex += 1
-
-		if cubeSize == -1:
+		if "Mesh" not in header or len(header["Mesh"]) < 2:
 			raise NameError("Invalid .3dl file.")
+		inputDepth = int(header["Mesh"][0])
+		outputDepth = int(header["Mesh"][1])
+		cubeSize = 2**inputDepth + 1
 
-		lattice = EmptyLatticeOfSize(cubeSize)
-		currentCubeIndex = 0
-		
-		for line in lutFileLines[meshLineIndex+1:]:
-			if len(line) > 0 and len(line.split()) == 3 and "#" not in line:
-				#valid cube line
-				redValue = line.split()[0]
-				greenValue = line.split()[1]
-				blueValue = line.split()[2]
-
-				redIndex = currentCubeIndex / (cubeSize*cubeSize)
-				greenIndex = ( (currentCubeIndex % (cubeSize*cubeSize)) / (cubeSize) )
-				blueIndex = currentCubeIndex % cubeSize
-
-				lattice[redIndex, greenIndex, blueIndex] = Color.FromRGBInteger(redValue, greenValue, blueValue, bitdepth = outputDepth)
-				currentCubeIndex += 1
+		# the first line of the body lists the input values of the mesh
+		body = body.split("\n", 1)[-1]
 
+		lattice = _LatticeFrom3DLBody(body, cubeSize, outputDepth, dtype)
 		return LUT(lattice, name = os.path.splitext(os.path.basename(lutFilePath))[0])
 
 	@staticmethod
-	def FromNuke3DLFile(lutFilePath):
+	@_CachedReader
+	def FromNuke3DLFile(lutFilePath, dtype = np.float64):
 		lutFile = open(lutFilePath, 'rU')
-		lutFileLines = lutFile.readlines()
+		header, body = _SplitHeaderAndBody(lutFile.read())
 		lutFile.close()
 
-		meshLineIndex = 0
-		cubeSize = -1
-		lineSkip = 0
-
-		for line in lutFileLines:
-			if "#" in line or line == "\n":
-				meshLineIndex += 1
-	
-		outputDepth = int(math.log(int(lutFileLines[meshLineIndex].split()[-1])+1,2))
-		cubeSize = len(lutFileLines[meshLineIndex].split())
-		
-	
-		if cubeSize == -1:
+		# the first line of the body lists the input values of the mesh
+		meshLine, body = (body.split("\n", 1) + [""])[:2]
+		meshValues = meshLine.split()
+		if len(meshValues) < 2:
 			raise NameError("Invalid .3dl file.")
 
-		lattice = EmptyLatticeOfSize(cubeSize)
-		currentCubeIndex = 0
-
-		# for line in lutFileLines[meshLineIndex+1:]:
-		for line in lutFileLines[meshLineIndex+1:]:
-			# print line
-			if len(line) > 0 and len(line.split()) == 3 and "#" not in line:
-				#valid cube line
-				redValue = line.split()[0]
-				greenValue = line.split()[1]
-				blueValue = line.split()[2]
+		outputDepth = int(math.log(int(meshValues[-1])+1,2))
+		cubeSize = len(meshValues)
 
-				redIndex = currentCubeIndex / (cubeSize*cubeSize)
-				greenIndex = ( (currentCubeIndex % (cubeSize*cubeSize)) / (cubeSize) )
-				blueIndex = currentCubeIndex % cubeSize
-
-				lattice[redIndex, greenIndex, blueIndex] = Color.FromRGBInteger(redValue, greenValue, blueValue, bitdepth = outputDepth)
-				currentCubeIndex += 1
+		lattice = _LatticeFrom3DLBody(body, cubeSize, outputDepth, dtype)
 		return LUT(lattice, name = os.path.splitext(os.path.basename(lutFilePath))[0])
 
 	@staticmethod
-	def FromCubeFile(cubeFilePath):
+	@_CachedReader
+	def FromCubeFile(cubeFilePath, dtype = np.float64, padWithLastPoint = True):
+		"""
+		Reads a .cube file. If the file has fewer points than LUT_3D_SIZE requires, the remaining points are filled with the last point when padWithLastPoint is set, otherwise the file is rejected.
+		A LUT_1D_SIZE table before the cube becomes the shaper, and a file with only a 1D table becomes a shaper in front of a size 2 identity cube.
+		DOMAIN_MIN and DOMAIN_MAX set the domain, as do LUT_1D_INPUT_RANGE and LUT_3D_INPUT_RANGE. With a shaper, LUT_3D_INPUT_RANGE is the range of the shaper output.
+		"""
 		cubeFile = open(cubeFilePath, 'rU')
-		cubeFileLines = cubeFile.readlines()
+		header, body = _SplitHeaderAndBody(cubeFile.read())
 		cubeFile.close()
 
-		cubeSizeLineIndex = 0
-		cubeSize = -1
-
-		for line in cubeFileLines:
-			if "LUT_3D_SIZE" in line:
-				cubeSize = int(line.split()[1])
-				break
-			cubeSizeLineIndex += 1
-		if cubeSize == -1:
+		if "LUT_3D_SIZE" not in header and "LUT_1D_SIZE" not in header:
 			raise NameError("Invalid .cube file.")
 
-		lattice = EmptyLatticeOfSize(cubeSize)
-		currentCubeIndex = 0
-		for line in cubeFileLines[cubeSizeLineIndex+1:]:
-			if len(line) > 0 and len(line.split()) == 3 and "#" not in line:
-				#valid cube line
-				redValue = float(line.split()[0])
-				greenValue = float(line.split()[1])
-				blueValue = float(line.split()[2])
-
-				redIndex = currentCubeIndex % cubeSize
-				greenIndex = ( (currentCubeIndex % (cubeSize*cubeSize)) / (cubeSize) )
-				blueIndex = currentCubeIndex / (cubeSize*cubeSize)
-
-				lattice[redIndex, greenIndex, blueIndex] = Color(redValue, greenValue, blueValue)
-				currentCubeIndex += 1
-
-		# if there are insufficient lines then fill with the last point
-		while currentCubeIndex < cubeSize**3:
-			redIndex = currentCubeIndex % cubeSize
-			greenIndex = ( (currentCubeIndex % (cubeSize*cubeSize)) / (cubeSize) )
-			blueIndex = currentCubeIndex / (cubeSize*cubeSize)
-			
-			redIndexOld = (currentCubeIndex-1) % cubeSize
-			greenIndexOld = ( ((currentCubeIndex-1) % (cubeSize*cubeSize)) / (cubeSize) )
-			blueIndexOld = (currentCubeIndex-1) / (cubeSize*cubeSize)
-
-			lattice[redIndex, greenIndex, blueIndex] = lattice[redIndexOld, greenIndexOld, blueIndexOld]
-			currentCubeIndex += 1
-
-		return LUT(lattice, name = os.path.splitext(os.path.basename(cubeFilePath))[0])
+		points = _ParseTriplets(body)
+		shaper = None
+		if "LUT_1D_SIZE" in header:
+			shaperSize = int(header["LUT_1D_SIZE"][0])
+			if points.shape[0] < shaperSize:
+				raise NameError("Invalid .cube file. Expected " + str(shaperSize) + " 1D points, found " + str(points.shape[0]) + ".")
+			shaper = points[:shaperSize]
+			points = points[shaperSize:]
+
+		domainMin, domainMax = 0.0, 1.0
+		if "DOMAIN_MIN" in header or "DOMAIN_MAX" in header:
+			domainMin = [float(x) for x in header.get("DOMAIN_MIN", [0.0] * 3)]
+			domainMax = [float(x) for x in header.get("DOMAIN_MAX", [1.0] * 3)]
+		elif shaper is not None and "LUT_1D_INPUT_RANGE" in header:
+			domainMin, domainMax = [float(x) for x in header["LUT_1D_INPUT_RANGE"]]
+		elif shaper is None and "LUT_3D_INPUT_RANGE" in header:
+			domainMin, domainMax = [float(x) for x in header["LUT_3D_INPUT_RANGE"]]
+		if shaper is not None and "LUT_3D_INPUT_RANGE" in header:
+			rangeMin, rangeMax = [float(x) for x in header["LUT_3D_INPUT_RANGE"]]
+			shaper = (shaper - rangeMin) / (rangeMax - rangeMin)
+
+		name = os.path.splitext(os.path.basename(cubeFilePath))[0]
+		if "LUT_3D_SIZE" not in header:
+			lattice = IdentityLattice(2, dtype)
+			return LUT(lattice, name = name, shaper = shaper, domainMin = domainMin, domainMax = domainMax)
+		cubeSize = int(header["LUT_3D_SIZE"][0])
+
+		pointCount = points.shape[0]
+		if pointCount > cubeSize**3 or pointCount == 0:
+			raise NameError("Invalid .cube file. Expected " + str(cubeSize**3) + " points, found " + str(pointCount) + ".")
+		if pointCount < cubeSize**3:
+			if not padWithLastPoint:
+				raise NameError("Invalid .cube file. Expected " + str(cubeSize**3) + " points, found " + str(pointCount) + ".")
+			# if there are insufficient lines then fill with the last point
+			padding = np.repeat(points[-1:], cubeSize**3 - pointCount, axis = 0)
+			points = np.concatenate((points, padding))
+
+		# .cube files are ordered with red changing fastest
+		lattice = np.ascontiguousarray(points.reshape(cubeSize, cubeSize, cubeSize, 3).transpose(2, 1, 0, 3), dtype)
+		return LUT(lattice, name = name, dtype = dtype, shaper = shaper, domainMin = domainMin, domainMax = domainMax)
 
 	@staticmethod
-	def FromFSIDatFile(datFilePath):
-		datBytes = bytearray(open(datFilePath, 'r').read())
-		cubeSize = 64
-		lattice = EmptyLatticeOfSize(cubeSize)
-		lutBytes = datBytes[128:]
-		for currentCubeIndex in xrange(len(lutBytes)/4):
-			rgb_packed = np.uint32(struct.unpack("<L", lutBytes[currentCubeIndex*4:(currentCubeIndex*4)+4])[0])
-
-			redValue = RemapIntTo01(rgb_packed & 1023, 1008)
-			greenValue = RemapIntTo01(rgb_packed >> 10 & 1023, 1008)
-			blueValue = RemapIntTo01(rgb_packed >> 20 & 1023, 1008)
+	@_CachedReader
+	def FromFSIDatFile(datFilePath, dtype = np.float64):
+		datFile = open(datFilePath, 'rb')
+		datBytes = datFile.read()
+		datFile.close()
 
-			redIndex = currentCubeIndex % cubeSize
-			greenIndex = ( (currentCubeIndex % (cubeSize*cubeSize)) / (cubeSize) )
-			blueIndex = currentCubeIndex / (cubeSize*cubeSize)
+		cubeSize = 64
+		if len(datBytes) < 128 + cubeSize**3 * 4:
+			raise NameError("Invalid .dat file.")
+
+		rgb_packed = np.frombuffer(datBytes, '<u4', count = cubeSize**3, offset = 128)
+		points = np.empty((cubeSize**3, 3), dtype)
+		points[:, 0] = rgb_packed & 1023
+		points[:, 1] = rgb_packed >> 10 & 1023
+		points[:, 2] = rgb_packed >> 20 & 1023
+		points /= points.dtype.type(1008)
+
+		# .dat files are ordered with red changing fastest
+		lattice = np.ascontiguousarray(points.reshape(cubeSize, cubeSize, cubeSize, 3).transpose(2, 1, 0, 3))
+		return LUT(lattice, name = os.path.splitext(os.path.basename(datFilePath))[0])
 
-			lattice[redIndex, greenIndex, blueIndex] = Color(redValue, greenValue, blueValue)
+	@staticmethod
+	def FromBinaryFile(binaryFilePath, memoryMap = True, verify = False):
+		"""
+		Reads a LUT written by ToBinaryFile. With memoryMap the lattice is a read-only memory map of the file instead of a copy in memory.
+		With verify the lattice is checked against the SHA-1 stored in the header.
+		"""
+		binaryFile = open(binaryFilePath, 'rb')
+		try:
+			prefix = binaryFile.read(len(BINARY_MAGIC) + _BINARY_PREFIX.size)
+			if len(prefix) != len(BINARY_MAGIC) + _BINARY_PREFIX.size or prefix[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+				raise NameError("Invalid pylut binary file.")
+			version, flags, headerLength = _BINARY_PREFIX.unpack(prefix[len(BINARY_MAGIC):])
+			if version != BINARY_VERSION:
+				raise NameError("Unsupported pylut binary file version: " + str(version))
+			try:
+				header = json.loads(binaryFile.read(headerLength).decode('ascii'))
+			except ValueError:
+				raise NameError("Invalid pylut binary file header.")
+
+			cubeSize = int(header["cubeSize"])
+			dtype = np.dtype(str(header["dtype"]))
+			shaperSize = int(header.get("shaperSize", 0))
+			shape = (cubeSize, cubeSize, cubeSize, 3)
+			offset = len(prefix) + headerLength
+			if os.path.getsize(binaryFilePath) < offset + (cubeSize**3 + shaperSize) * 3 * dtype.itemsize:
+				raise NameError("Truncated pylut binary file.")
+
+			if memoryMap:
+				lattice = np.memmap(binaryFilePath, dtype = dtype, mode = 'r', offset = offset, shape = shape)
+			else:
+				lattice = np.fromfile(binaryFile, dtype = dtype, count = cubeSize**3 * 3).reshape(shape)
+			shaper = None
+			if shaperSize > 0:
+				binaryFile.seek(offset + lattice.nbytes)
+				shaper = np.fromfile(binaryFile, dtype = dtype, count = shaperSize * 3).reshape(shaperSize, 3)
+		finally:
+			binaryFile.close()
 
-		return LUT(lattice, name = os.path.splitext(os.path.basename(datFilePath))[0])
+		if verify and _LatticeHash(lattice) != header["hash"]:
+			raise NameError("pylut binary file does not match its checksum.")
+		if not dtype.isnative:
+			lattice = lattice.astype(dtype.newbyteorder('='))
+		return LUT(lattice, name = header["name"], shaper = shaper, domainMin = header["domainMin"], domainMax = header["domainMax"])
 
 
 
@@ -644,67 +1693,63 @@ class LUT:
 		"""
 		Add a Color value to every lattice point on the cube.
 		"""
-		cubeSize = self.cubeSize
-		newLattice = EmptyLatticeOfSize(cubeSize)
-		for r in xrange(cubeSize):
-			for g in xrange(cubeSize):
-				for b in xrange(cubeSize):
-					newLattice[r, g, b] = self.lattice[r, g, b] + color
-		return LUT(newLattice)
+		return self._Elementwise("add", self._ColorAsArray(color))
 
 	def SubtractColorFromEachPoint(self, color):
 		"""
 		Subtract a Color value to every lattice point on the cube.
 		"""
-		cubeSize = self.cubeSize
-		newLattice = EmptyLatticeOfSize(cubeSize)
-		for r in xrange(cubeSize):
-			for g in xrange(cubeSize):
-				for b in xrange(cubeSize):
-					newLattice[r, g, b] = self.lattice[r, g, b] - color
-		return LUT(newLattice)
+		return self._Elementwise("subtract", self._ColorAsArray(color))
 
 	def MultiplyEachPoint(self, color):
 		"""
 		Multiply by a Color value or float for every lattice point on the cube.
 		"""
-		cubeSize = self.cubeSize
-		newLattice = EmptyLatticeOfSize(cubeSize)
-		for r in xrange(cubeSize):
-			for g in xrange(cubeSize):
-				for b in xrange(cubeSize):
-					newLattice[r, g, b] = self.lattice[r, g, b] * color
-		return LUT(newLattice)
+		if not isinstance(color, Color):
+			return self._Elementwise("multiply", self.dtype.type(color))
+		return self._Elementwise("multiply", self._ColorAsArray(color))
+
+	def _ColorAsArray(self, color):
+		"""
+		Used internally to broadcast a Color against the lattice without changing its dtype.
+		"""
+		return np.asarray(color.ToFloatArray(), self.dtype)
 
 
 	def __add__(self, other):
-		if self.cubeSize is not other.cubeSize:
+		if self.cubeSize != other.cubeSize:
 			raise NameError("Lattice Sizes not equivalent")
+		if not self._SameInputStage(other):
+			raise NameError("LUT shapers or domains not equivalent")
 
-		return LUT(self.lattice + other.lattice)
+		return self._Elementwise("add", other)
 
 	def __sub__(self, other):
-		if self.cubeSize is not other.cubeSize:
+		if self.cubeSize != other.cubeSize:
 			raise NameError("Lattice Sizes not equivalent")
+		if not self._SameInputStage(other):
+			raise NameError("LUT shapers or domains not equivalent")
 
-		return LUT(self.lattice - other.lattice)
+		return self._Elementwise("subtract", other)
 
 	def __mul__(self, other):
 		className = other.__class__.__name__
 		if "Color" in className or "float" in className or "int" in className:
 			return self.MultiplyEachPoint(other)
 
-		if self.cubeSize is not other.cubeSize:
+		if self.cubeSize != other.cubeSize:
 			raise NameError("Lattice Sizes not equivalent")
+		if not self._SameInputStage(other):
+			raise NameError("LUT shapers or domains not equivalent")
 
-		return LUT(self.lattice * other.lattice)
+		return self._Elementwise("multiply", other)
 
 	def __rmul__(self, other):
 		return self.__mul__(other)
 
 	def __eq__(self, lut):
 		if isinstance(lut, LUT):
-			return (self.lattice == lut.lattice).all()
+			return self._SameInputStage(lut) and (self.lattice == lut.lattice).all()
 		return NotImplemented
 
 	def __ne__(self, lut):
@@ -776,3 +1821,145 @@ class LUT:
 		# plot 3D values
 		ax.scatter(red_values, green_values, blue_values, c=colors, marker="o")
 		matplotlib.pyplot.show()
+
+
+class LUTCache:
+	"""
+	Cache of parsed LUTs used by the LUT.From*File readers once enabled with EnableLUTCache.
+	Entries are keyed by the reader and its arguments and by the absolute path, size and modification time of the file. Entries on disk are also keyed by a SHA-1 of its contents.
+	Parsed LUTs are kept in memory up to maxMemoryBytes of lattice and, with a directory, stored there in the native binary format up to maxDiskBytes, least recently used first out.
+	Several processes can share a directory: entries are written to a temporary file and renamed into place, and a missing or unreadable entry is just a miss.
+	Every call gets a new LUT around read-only views of the cached lattice and shaper, whether it was a hit or a miss, so callers cannot change what later calls get. Copy the lattice to edit it.
+	"""
+	def __init__(self, directory = None, maxMemoryBytes = 256 * 1024**2, maxDiskBytes = 1024**3):
+		self.directory = None if directory is None else os.path.abspath(os.path.expanduser(directory))
+		self.maxMemoryBytes = maxMemoryBytes
+		self.maxDiskBytes = maxDiskBytes
+		self._entries = OrderedDict()
+		self._memoryBytes = 0
+		self._lock = threading.Lock()
+		if self.directory is not None:
+			_MakeDirectory(self.directory)
+
+	def Load(self, reader, lutFilePath, *args, **kwargs):
+		"""
+		Returns the LUT that reader(lutFilePath, *args, **kwargs) parses, from the cache when the file has not changed.
+		"""
+		lutFilePath = os.path.abspath(lutFilePath)
+		stat = os.stat(lutFilePath)
+		statKey = (reader.__name__, repr(args), repr(sorted(kwargs.items())), lutFilePath, stat.st_size, stat.st_mtime)
+
+		with self._lock:
+			lut = self._entries.pop(statKey, None)
+			if lut is not None:
+				self._entries[statKey] = lut
+				return self._ReadOnlyLUT(lut)
+
+		lutFile = open(lutFilePath, 'rb')
+		contentHash = hashlib.sha1(lutFile.read()).hexdigest()
+		lutFile.close()
+		entryName = hashlib.sha1((repr(statKey) + contentHash).encode('ascii')).hexdigest() + BINARY_EXTENSION
+
+		lut = self._LoadFromDisk(entryName)
+		if lut is None:
+			lut = reader(lutFilePath, *args, **kwargs)
+			self._StoreOnDisk(entryName, lut)
+		lut.lattice.setflags(write = False)
+		if lut.shaper is not None:
+			lut.shaper.setflags(write = False)
+		self._StoreInMemory(statKey, lut)
+		return self._ReadOnlyLUT(lut)
+
+	def Clear(self):
+		"""
+		Empties the in-memory cache and removes every entry from the cache directory.
+		"""
+		with self._lock:
+			self._entries.clear()
+			self._memoryBytes = 0
+		for entryPath, size, accessTime in self._DiskEntries():
+			self._RemoveFile(entryPath)
+
+	@staticmethod
+	def _ReadOnlyLUT(lut):
+		shaper = None if lut.shaper is None else lut.shaper.view()
+		return LUT(lut.lattice.view(), name = lut.name, shaper = shaper, domainMin = lut.domainMin, domainMax = lut.domainMax)
+
+	def _StoreInMemory(self, statKey, lut):
+		with self._lock:
+			if statKey in self._entries:
+				self._memoryBytes -= self._entries.pop(statKey).lattice.nbytes
+			self._entries[statKey] = lut
+			self._memoryBytes += lut.lattice.nbytes
+			while self._memoryBytes > self.maxMemoryBytes and len(self._entries) > 1:
+				self._memoryBytes -= self._entries.popitem(last = False)[1].lattice.nbytes
+
+	def _LoadFromDisk(self, entryName):
+		if self.directory is None:
+			return None
+		entryPath = os.path.join(self.directory, entryName)
+		try:
+			lut = LUT.FromBinaryFile(entryPath)
+			os.utime(entryPath, None)
+			return lut
+		except (IOError, OSError, NameError, ValueError):
+			return None
+
+	def _StoreOnDisk(self, entryName, lut):
+		if self.directory is None:
+			return
+		fileDescriptor, temporaryPath = tempfile.mkstemp(suffix = ".tmp", dir = self.directory)
+		os.close(fileDescriptor)
+		try:
+			lut.ToBinaryFile(temporaryPath)
+			os.rename(temporaryPath, os.path.join(self.directory, entryName))
+		except (IOError, OSError):
+			self._RemoveFile(temporaryPath)
+			return
+		self._EvictFromDisk()
+
+	def _DiskEntries(self):
+		entries = []
+		if self.directory is None:
+			return entries
+		for fileName in os.listdir(self.directory):
+			if not fileName.endswith(BINARY_EXTENSION):
+				continue
+			entryPath = os.path.join(self.directory, fileName)
+			try:
+				stat = os.stat(entryPath)
+			except OSError:
+				continue
+			entries.append((entryPath, stat.st_size, stat.st_mtime))
+		return entries
+
+	def _EvictFromDisk(self):
+		entries = sorted(self._DiskEntries(), key = lambda entry: entry[2])
+		totalBytes = sum(size for entryPath, size, accessTime in entries)
+		for entryPath, size, accessTime in entries[:-1]:
+			if totalBytes <= self.maxDiskBytes:
+				break
+			self._RemoveFile(entryPath)
+			totalBytes -= size
+
+	@staticmethod
+	def _RemoveFile(path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+def EnableLUTCache(directory = None, maxMemoryBytes = 256 * 1024**2, maxDiskBytes = 1024**3):
+	"""
+	Makes every LUT.From*File reader go through a LUTCache with these settings, and returns it. Without a directory only the in-memory cache is used.
+	"""
+	global _lutCache
+	_lutCache = LUTCache(directory, maxMemoryBytes, maxDiskBytes)
+	return _lutCache
+
+def DisableLUTCache():
+	"""
+	Makes the LUT.From*File readers parse their files on every call again.
+	"""
+	global _lutCache
+	_lutCache = None